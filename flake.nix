@@ -62,6 +62,7 @@
 
           propagatedBuildInputs = with python.pkgs; [
             attrs
+            orjson
           ];
 
           preFixup = ''
@@ -1,11 +1,14 @@
 """Build derivations and collect results."""
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
+import asyncio
+import contextlib
+import functools
+import os
+from dataclasses import dataclass, replace
 from pathlib import Path
 
 from .flake import ChangeSet, DerivationInfo
-from .utils import run_command
+from .utils import json_loads, run_command, tail_lines
 
 
 @dataclass
@@ -50,55 +53,254 @@ class BuildResults:
         """Number of failed builds."""
         return len(self.failed)
 
+    @functools.cached_property
+    def by_attr_path(self) -> dict[str, BuildResult]:
+        """Results keyed by attribute path, built on first use.
 
-def build_derivation(
+        Shared by every report renderer; ``results`` must not be modified
+        after this is first read.
+        """
+        return {r.derivation.attr_path: r for r in self.results}
+
+
+# Build logs can carry very long lines, so raise asyncio's default 64 KiB
+# line limit.
+_LINE_LIMIT = 16 * 1024 * 1024
+
+# Only the end of a build log is useful for diagnosing a failure.
+_BUILD_LOG_TAIL_LINES = 200
+
+
+def _terminate(proc: asyncio.subprocess.Process) -> None:
+    """Stop a subprocess whose task was cancelled (e.g. by --fail-fast)."""
+    with contextlib.suppress(ProcessLookupError):
+        proc.terminate()
+
+
+async def _tail_lines(stream: asyncio.StreamReader) -> list[str]:
+    """Consume a stream, keeping only its last lines.
+
+    Lines are buffered and cut back to the tail whenever the buffer
+    doubles, so memory stays bounded by the tail length.
+    """
+    lines: list[str] = []
+    async for line in stream:
+        lines.append(line.decode(errors="replace"))
+        if len(lines) >= 2 * _BUILD_LOG_TAIL_LINES:
+            lines = tail_lines(lines, _BUILD_LOG_TAIL_LINES)
+    return tail_lines(lines, _BUILD_LOG_TAIL_LINES)
+
+
+async def _nix_build(derivation: DerivationInfo, installable: str) -> BuildResult:
+    """Run ``nix build`` on an installable and wrap the outcome.
+
+    Build logs are streamed rather than buffered: a chatty build can log
+    hundreds of MB, so only the last lines are kept, and only on failure.
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "nix",
+            "build",
+            installable,
+            "--no-link",
+            "--print-out-paths",
+            "--print-build-logs",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=_LINE_LIMIT,
+        )
+    except Exception as e:
+        return BuildResult(derivation=derivation, success=False, error=str(e))
+
+    assert proc.stdout is not None and proc.stderr is not None
+    try:
+        stdout, tail = await asyncio.gather(
+            proc.stdout.read(), _tail_lines(proc.stderr)
+        )
+        await proc.wait()
+    except asyncio.CancelledError:
+        _terminate(proc)
+        raise
+    except Exception as e:
+        _terminate(proc)
+        return BuildResult(derivation=derivation, success=False, error=str(e))
+
+    if proc.returncode == 0:
+        return BuildResult(
+            derivation=derivation,
+            success=True,
+            output_path=stdout.decode().strip(),
+        )
+    log = "\n".join(tail)
+    return BuildResult(
+        derivation=derivation,
+        success=False,
+        error=log.strip() or "Build failed",
+        build_log=log,
+    )
+
+
+async def build_derivation(
     flake_path: Path,
     derivation: DerivationInfo,
 ) -> BuildResult:
     """Build a single derivation.
 
+    Builds straight from the drvPath found while comparing outputs, so the
+    flake isn't evaluated again; the flake attribute is only used when no
+    drvPath is known.
+
     Args:
         flake_path: Path to the flake
         derivation: Derivation to build
     """
+    if derivation.drv_path:
+        return await _nix_build(derivation, f"{derivation.drv_path}^*")
+    return await _nix_build(derivation, f"{flake_path}#{derivation.attr_path}")
+
+
+def _derivations_to_build(changes: ChangeSet) -> list[DerivationInfo]:
+    """Collect the derivations that need building (added + new side of modified)."""
+    to_build: list[DerivationInfo] = []
+    to_build.extend(changes.added)
+    to_build.extend([new for old, new in changes.modified])
+    return to_build
+
+
+def find_realised_outputs(
+    derivations: list[DerivationInfo],
+) -> dict[str, list[str]]:
+    """Find derivations whose outputs are all valid in the local store.
+
+    Returns a mapping of drv path to its output paths. Uses two batched
+    calls regardless of the number of derivations: ``nix derivation show``
+    for the output paths and ``nix-store --check-validity`` to test them.
+    Derivations whose outputs can't be determined up front (e.g.
+    content-addressed ones) are left to ``nix build``.
+    """
+    wanted = {drv.drv_path for drv in derivations}
+    drv_paths = sorted(wanted)
+    if not drv_paths:
+        return {}
+
     try:
+        result = run_command(["nix", "derivation", "show", *drv_paths], check=False)
+        if result.returncode != 0:
+            return {}
+        shown = json_loads(result.stdout)
+        # Newer Nix versions wrap the derivations in a versioned envelope
+        if isinstance(shown.get("derivations"), dict):
+            shown = shown["derivations"]
+
+        store_dir = str(Path(drv_paths[0]).parent)
+        outputs: dict[str, list[str]] = {}
+        for key, drv_json in shown.items():
+            drv_outputs = drv_json.get("outputs") or {}
+            paths = [out.get("path") for out in drv_outputs.values()]
+            if not paths or not all(paths):
+                continue
+            outputs[f"{store_dir}/{Path(key).name}"] = [
+                f"{store_dir}/{Path(path).name}" for path in paths
+            ]
+
+        all_paths = [path for paths in outputs.values() for path in paths]
+        if not all_paths:
+            return {}
         result = run_command(
-            [
-                "nix",
-                "build",
-                f"{flake_path}#{derivation.attr_path}",
-                "--no-link",
-                "--print-out-paths",
-            ],
+            ["nix-store", "--check-validity", "--print-invalid", *all_paths],
             check=False,
         )
+        if result.returncode != 0:
+            return {}
+    except Exception:
+        return {}
 
-        if result.returncode == 0:
-            return BuildResult(
-                derivation=derivation,
-                success=True,
-                output_path=result.stdout.strip(),
-            )
-        else:
-            return BuildResult(
-                derivation=derivation,
-                success=False,
-                error=result.stderr.strip() if result.stderr else "Build failed",
-                build_log=result.stderr,
-            )
+    invalid = set(result.stdout.split())
+    return {
+        drv_path: paths
+        for drv_path, paths in outputs.items()
+        if drv_path in wanted and not invalid.intersection(paths)
+    }
 
-    except Exception as e:
-        return BuildResult(
-            derivation=derivation,
-            success=False,
-            error=str(e),
+
+class _BuildTracker:
+    """Collects finished builds, prints progress, and implements --fail-fast.
+
+    With fail_fast, the first failure cancels every other registered task;
+    cancelled builds terminate their ``nix build`` and produce no result.
+    """
+
+    def __init__(self, total: int, fail_fast: bool = False) -> None:
+        self.total = total
+        self.fail_fast = fail_fast
+        self.results: list[BuildResult] = []
+        self.tasks: list[asyncio.Task[None]] = []
+        self.stopped = False
+
+    def record(self, result: BuildResult) -> None:
+        """Record a finished build; on a fail-fast failure, cancel the rest."""
+        self.results.append(result)
+        status = "\u2705" if result.success else "\u274c"
+        print(
+            f"  [{len(self.results)}/{self.total}] {status} "
+            f"{result.derivation.attr_path}"
         )
+        if self.fail_fast and not result.success and not self.stopped:
+            self.stopped = True
+            current = asyncio.current_task()
+            for task in self.tasks:
+                if task is not current:
+                    task.cancel()
+
+
+async def build_changes_async(
+    flake_path: Path,
+    to_build: list[DerivationInfo],
+    max_workers: int = 4,
+    fail_fast: bool = False,
+) -> BuildResults:
+    """Build changed derivations, one ``nix build`` per derivation.
+
+    Args:
+        flake_path: Path to the flake
+        to_build: Derivations to build
+        max_workers: Maximum number of concurrent builds
+        fail_fast: Cancel the remaining builds after the first failure
+    """
+    tracker = _BuildTracker(len(to_build), fail_fast)
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def build(drv: DerivationInfo) -> None:
+        async with semaphore:
+            try:
+                result = await build_derivation(flake_path, drv)
+            except Exception as e:
+                result = BuildResult(
+                    derivation=drv,
+                    success=False,
+                    error=f"Unexpected error: {e}",
+                )
+        tracker.record(result)
+
+    tracker.tasks = [asyncio.create_task(build(drv)) for drv in to_build]
+    await asyncio.gather(*tracker.tasks, return_exceptions=True)
+
+    return BuildResults(results=tracker.results)
+
+
+def _default_max_workers() -> int:
+    """Number of CPUs this process may run on (respects affinity/cgroups)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        return os.cpu_count() or 4
 
 
 def build_changes(
     flake_path: Path,
     changes: ChangeSet,
-    max_workers: int = 4,
+    max_workers: int | None = None,
+    fail_fast: bool = False,
 ) -> BuildResults:
     """Build all changed derivations in parallel.
 
@@ -106,38 +308,60 @@ def build_changes(
         flake_path: Path to the flake
         changes: ChangeSet containing derivations to build
         max_workers: Maximum number of parallel build workers
+            (default: number of usable CPUs)
+        fail_fast: Cancel the remaining builds after the first failure;
+            cancelled builds are left out of the results
     """
-    to_build: list[DerivationInfo] = []
-    to_build.extend(changes.added)
-    to_build.extend([new for old, new in changes.modified])
+    if max_workers is None:
+        max_workers = _default_max_workers()
+
+    to_build = _derivations_to_build(changes)
 
     if not to_build:
         return BuildResults(results=[])
 
-    total = len(to_build)
-    print(f"Building {total} package(s)...\n")
+    realised = find_realised_outputs(to_build)
+    results = [
+        BuildResult(
+            derivation=drv,
+            success=True,
+            output_path="\n".join(realised[drv.drv_path]),
+        )
+        for drv in to_build
+        if drv.drv_path in realised
+    ]
+    to_build = [drv for drv in to_build if drv.drv_path not in realised]
+    if results:
+        print(f"Skipping {len(results)} package(s) already in the local store")
 
-    results = []
+    if not to_build:
+        return BuildResults(results=results)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_drv = {
-            executor.submit(build_derivation, flake_path, drv): drv for drv in to_build
-        }
+    # Attributes that alias the same derivation (e.g. ``default`` and the
+    # package it points at) only need one build; its result is shared.
+    unique: dict[str, DerivationInfo] = {}
+    aliases: dict[str, list[DerivationInfo]] = {}
+    for drv in to_build:
+        if drv.drv_path in unique:
+            aliases.setdefault(drv.drv_path, []).append(drv)
+        else:
+            unique[drv.drv_path] = drv
 
-        for future in as_completed(future_to_drv):
-            drv = future_to_drv[future]
-            try:
-                result = future.result()
-                results.append(result)
-            except Exception as e:
-                results.append(
-                    BuildResult(
-                        derivation=drv,
-                        success=False,
-                        error=f"Unexpected error: {e}",
-                    )
-                )
-            status = "\u2705" if results[-1].success else "\u274c"
-            print(f"  [{len(results)}/{total}] {status} {drv.attr_path}")
+    print(f"Building {len(unique)} package(s)...\n")
+
+    built = asyncio.run(
+        build_changes_async(flake_path, list(unique.values()), max_workers, fail_fast)
+    )
+
+    skipped = len(unique) - built.total_count
+    if skipped:
+        print(f"\nCancelled {skipped} remaining build(s) after a failure (--fail-fast)")
+
+    for result in built.results:
+        results.append(result)
+        results.extend(
+            replace(result, derivation=alias)
+            for alias in aliases.get(result.derivation.drv_path, [])
+        )
 
     return BuildResults(results=results)
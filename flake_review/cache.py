@@ -0,0 +1,35 @@
+"""On-disk JSON caches for results that are fixed for a given git revision."""
+
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+
+def get_cache_dir() -> Path:
+    """Get the flake-review cache directory ($XDG_CACHE_HOME/flake-review)."""
+    base = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(base) / "flake-review"
+
+
+def load_json_cache(path: Path) -> Any:
+    """Read a JSON cache file, returning None if it is missing or unreadable."""
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def save_json_cache(path: Path, data: Any) -> None:
+    """Write a JSON cache file atomically, ignoring write errors.
+
+    The cache is an optimization only, so a read-only or full disk must
+    never fail the review.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(data))
+        tmp_path.replace(path)
+    except OSError:
+        pass
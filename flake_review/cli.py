@@ -2,16 +2,16 @@
 
 import argparse
 import os
-import shutil
 import sys
 import tempfile
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from . import __version__
 from .build import build_changes
 from .cachix import push_to_cachix
-from .flake import FlakeOutputs, compare_outputs
+from .flake import FlakeOutputs, compare_outputs, packages_owning_files
 from .github import GithubClient, parse_pr_url
 from .report import (
     collect_nix_diffs,
@@ -22,13 +22,50 @@ from .report import (
     merge_markdown_reports,
     print_console_report,
 )
-from .utils import GitWorktree, get_current_system, get_git_root, run_command
+from .utils import (
+    CommandError,
+    GitWorktree,
+    get_changed_files,
+    get_current_system,
+    get_git_root,
+    git_worktrees,
+    has_tree_changes,
+    json_dumps,
+    remove_tree_in_background,
+    run_command,
+)
 
 
 def _get_systems(args: argparse.Namespace) -> list[str]:
     return args.systems.split(",") if args.systems else [get_current_system()]
 
 
+def _get_package_filter(
+    args: argparse.Namespace,
+    repo_path: Path,
+    base: str,
+    head: str | None,
+    head_outputs: FlakeOutputs,
+    systems: list[str],
+) -> list[str] | None:
+    """Resolve --package, or guess it from the diff when --prefilter is set."""
+    if args.package or not args.prefilter:
+        return list(args.package) if args.package else None
+
+    try:
+        changed_files = get_changed_files(repo_path, base, head)
+    except CommandError:
+        changed_files = []
+    packages = packages_owning_files(
+        head_outputs.get_source_positions("packages", systems), changed_files
+    )
+    if packages is None:
+        print("Prefilter: changes can't be scoped to packages, reviewing all")
+    else:
+        print(f"Prefilter: reviewing {len(packages)} package(s) owning changed files")
+    return packages
+
+
 def _review_changes(
     base_outputs: FlakeOutputs,
     head_outputs: FlakeOutputs,
@@ -39,6 +76,7 @@ def _review_changes(
     available_systems: set[str] | None = None,
     title: str = "Flake Review Results",
     post_callback: Callable[[str], None] | None = None,
+    package_filter: list[str] | None = None,
 ) -> int:
     """Run compare → build → report for a pair of FlakeOutputs.
 
@@ -49,7 +87,7 @@ def _review_changes(
         head_outputs,
         output_types=["packages"],
         systems=systems,
-        package_filter=args.package,
+        package_filter=package_filter,
     )
 
     total_changes = len(changes.added) + len(changes.modified) + len(changes.removed)
@@ -71,7 +109,12 @@ def _review_changes(
         return 0
 
     if args.build:
-        results = build_changes(head_path, changes, max_workers=args.max_workers)
+        results = build_changes(
+            head_path,
+            changes,
+            max_workers=args.max_workers,
+            fail_fast=args.fail_fast,
+        )
     else:
         from .build import BuildResults
 
@@ -84,19 +127,21 @@ def _review_changes(
 
     nix_diffs = collect_nix_diffs(changes)
 
+    # Reports store and render the system lists sorted; sort once here.
+    requested_systems = sorted(systems)
+    sorted_available = sorted(available_systems) if available_systems else None
+
     print_console_report(changes, results, nix_diffs=nix_diffs)
 
     if output_file and output_format == "json":
-        import json
-
         json_data = generate_json_report(
             changes,
             results,
-            requested_systems=systems,
-            available_systems=available_systems,
+            requested_systems=requested_systems,
+            available_systems=sorted_available,
             nix_diffs=nix_diffs,
         )
-        Path(output_file).write_text(json.dumps(json_data, indent=2))
+        Path(output_file).write_text(json_dumps(json_data, indent=True))
         print(f"Report written to {output_file}")
 
     markdown = None
@@ -105,8 +150,8 @@ def _review_changes(
             changes,
             results,
             title=title,
-            requested_systems=systems,
-            available_systems=available_systems,
+            requested_systems=requested_systems,
+            available_systems=sorted_available,
             nix_diffs=nix_diffs,
             markdown_ansi=markdown_ansi,
         )
@@ -143,6 +188,9 @@ def cmd_pr(args: argparse.Namespace) -> int:
 
     try:
         client = GithubClient()
+        # The marker comment is looked up by post_comment, right before
+        # posting: a build can take hours, and an id fetched now could be
+        # stale by then (or not needed at all without --post-result).
         pr = client.get_pull_request(owner, repo, pr_number)
         print(f"Base: {pr.base_ref}, Head: {pr.head_ref}")
     except Exception as e:
@@ -157,26 +205,29 @@ def cmd_pr(args: argparse.Namespace) -> int:
     temp_dir = Path(tempfile.mkdtemp(prefix=f"flake-review-{repo}-"))
 
     try:
+        # Only the base and head snapshots are needed, so fetch exactly those
+        # two commits at depth 1 instead of cloning the full history.
         print(f"\nCloning https://github.com/{owner}/{repo}.git...")
-        run_command(["git", "clone", "--quiet", repo_url, str(temp_dir)])
+        run_command(["git", "init", "--quiet", str(temp_dir)])
         repo_path = temp_dir
+        run_command(["git", "remote", "add", "origin", repo_url], cwd=repo_path)
 
         base_sha = pr.base_sha
         head_sha = pr.head_sha
+        fetch = ["git", "fetch", "--quiet", "--depth=1", "--no-tags"]
 
         if pr.is_fork:
             assert pr.head_repo_url is not None  # Guaranteed by is_fork
             print("Fetching from fork...")
-            run_command(
-                ["git", "fetch", pr.head_repo_url, head_sha],
-                cwd=repo_path,
-            )
+            run_command([*fetch, "origin", base_sha], cwd=repo_path)
+            run_command([*fetch, pr.head_repo_url, head_sha], cwd=repo_path)
         else:
             print("Fetching commits...")
-            run_command(
-                ["git", "fetch", "origin", head_sha],
-                cwd=repo_path,
-            )
+            run_command([*fetch, "origin", base_sha, head_sha], cwd=repo_path)
+
+        if not has_tree_changes(repo_path, base_sha, head_sha):
+            print("No tracked files changed, nothing to evaluate.")
+            return 0
 
         requested_systems = _get_systems(args)
         print(f"Requested systems: {', '.join(requested_systems)}")
@@ -185,54 +236,64 @@ def cmd_pr(args: argparse.Namespace) -> int:
         head_short = f"{pr.head_ref} ({head_sha[:8]})"
         print(f"\nComparing {base_short} vs {head_short}...")
 
-        with GitWorktree(repo_path, base_sha) as base_path:
-            with GitWorktree(repo_path, head_sha) as head_path:
-                base_outputs = FlakeOutputs(base_path)
-                head_outputs = FlakeOutputs(head_path)
-
-                print("\nChecking flake inputs...")
-                try:
-                    base_lock = (base_path / "flake.lock").read_text()
-                    head_lock = (head_path / "flake.lock").read_text()
-                    if base_lock != head_lock:
-                        print("⚠️  flake.lock changed")
-                    else:
-                        print("✅ flake.lock unchanged")
-                except Exception:
-                    pass
-
-                base_raw = base_outputs._get_raw_outputs()
-                head_raw = head_outputs._get_raw_outputs()
-
-                available_systems: set[str] = set()
-                if "packages" in base_raw:
-                    available_systems.update(base_raw["packages"].keys())
-                if "packages" in head_raw:
-                    available_systems.update(head_raw["packages"].keys())
-
-                unavailable = set(requested_systems) - available_systems
-                if unavailable:
-                    print(f"⚠️  Systems not in flake: {', '.join(sorted(unavailable))}")
-                if available_systems:
-                    print(f"Available systems: {', '.join(sorted(available_systems))}")
-
-                title = f"Flake Review Results for [#{pr_number}]({pr.url})"
-
-                return _review_changes(
-                    base_outputs,
+        with git_worktrees(repo_path, base_sha, head_sha) as (base_path, head_path):
+            base_outputs = FlakeOutputs(base_path, immutable=True)
+            head_outputs = FlakeOutputs(head_path, immutable=True)
+
+            print("\nChecking flake inputs...")
+            try:
+                base_lock = (base_path / "flake.lock").read_text()
+                head_lock = (head_path / "flake.lock").read_text()
+                if base_lock != head_lock:
+                    print("⚠️  flake.lock changed")
+                else:
+                    print("✅ flake.lock unchanged")
+            except Exception:
+                pass
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                base_raw, head_raw = executor.map(
+                    FlakeOutputs._get_raw_outputs, (base_outputs, head_outputs)
+                )
+
+            available_systems: set[str] = set()
+            if "packages" in base_raw:
+                available_systems.update(base_raw["packages"].keys())
+            if "packages" in head_raw:
+                available_systems.update(head_raw["packages"].keys())
+
+            unavailable = set(requested_systems) - available_systems
+            if unavailable:
+                print(f"⚠️  Systems not in flake: {', '.join(sorted(unavailable))}")
+            if available_systems:
+                print(f"Available systems: {', '.join(sorted(available_systems))}")
+
+            title = f"Flake Review Results for [#{pr_number}]({pr.url})"
+
+            return _review_changes(
+                base_outputs,
+                head_outputs,
+                head_path,
+                requested_systems,
+                args,
+                available_systems=available_systems,
+                title=title,
+                post_callback=lambda md: client.post_comment(pr, md),
+                package_filter=_get_package_filter(
+                    args,
+                    repo_path,
+                    base_sha,
+                    head_sha,
                     head_outputs,
-                    head_path,
                     requested_systems,
-                    args,
-                    available_systems=available_systems,
-                    title=title,
-                    post_callback=lambda md: client.post_comment(pr, md),
-                )
+                ),
+            )
 
     finally:
+        client.close()
         if temp_dir.exists():
             print(f"\nCleaning up {temp_dir}...")
-            shutil.rmtree(temp_dir)
+            remove_tree_in_background(temp_dir)
 
 
 def cmd_local(args: argparse.Namespace) -> int:
@@ -263,15 +324,23 @@ def cmd_local(args: argparse.Namespace) -> int:
             base_ref = "HEAD~1"
             print("No upstream branch found, comparing working tree against HEAD~1...")
 
+    if not has_tree_changes(repo_path, base_ref):
+        print("No tracked files changed, nothing to evaluate.")
+        return 0
+
     # Base is a clean worktree; head is the working directory so uncommitted
     # changes are included (Nix evaluates the dirty tree).
     with GitWorktree(repo_path, base_ref) as base_path:
+        head_outputs = FlakeOutputs(repo_path)
         return _review_changes(
-            FlakeOutputs(base_path),
-            FlakeOutputs(repo_path),
+            FlakeOutputs(base_path, immutable=True),
+            head_outputs,
             repo_path,
             systems,
             args,
+            package_filter=_get_package_filter(
+                args, repo_path, base_ref, None, head_outputs, systems
+            ),
         )
 
 
@@ -282,15 +351,30 @@ def cmd_compare(args: argparse.Namespace) -> int:
     print(f"Building for systems: {', '.join(systems)}")
     print(f"Comparing {args.base_ref} vs {args.target_ref}...")
 
-    with GitWorktree(repo_path, args.base_ref) as base_path:
-        with GitWorktree(repo_path, args.target_ref) as target_path:
-            return _review_changes(
-                FlakeOutputs(base_path),
-                FlakeOutputs(target_path),
-                target_path,
-                systems,
+    if not has_tree_changes(repo_path, args.base_ref, args.target_ref):
+        print("No tracked files changed, nothing to evaluate.")
+        return 0
+
+    with git_worktrees(repo_path, args.base_ref, args.target_ref) as (
+        base_path,
+        target_path,
+    ):
+        target_outputs = FlakeOutputs(target_path, immutable=True)
+        return _review_changes(
+            FlakeOutputs(base_path, immutable=True),
+            target_outputs,
+            target_path,
+            systems,
+            args,
+            package_filter=_get_package_filter(
                 args,
-            )
+                repo_path,
+                args.base_ref,
+                args.target_ref,
+                target_outputs,
+                systems,
+            ),
+        )
 
 
 def cmd_merge_reports(args: argparse.Namespace) -> int:
@@ -331,9 +415,9 @@ def cmd_merge_reports(args: argparse.Namespace) -> int:
 
     if args.post_result:
         owner, repo, pr_number = parse_pr_url(args.pr_url)
-        client = GithubClient()
-        pr = client.get_pull_request(owner, repo, pr_number)
-        client.post_comment(pr, merged_for_post or merged)
+        with GithubClient() as client:
+            pr, _ = client.get_pr_and_marker_comment(owner, repo, pr_number)
+            client.post_comment(pr, merged_for_post or merged)
         print(f"✅ Posted results to {pr.url}")
 
     return 0
@@ -347,6 +431,15 @@ def _add_common_args(p: argparse.ArgumentParser, *, has_build: bool = True) -> N
         action="append",
         help="Only review specific packages (can be repeated)",
     )
+    p.add_argument(
+        "--prefilter",
+        action="store_true",
+        help=(
+            "Only review packages whose meta.position directory contains a "
+            "changed file (may miss packages that depend on changed files "
+            "elsewhere)"
+        ),
+    )
     p.add_argument(
         "--systems",
         help="Comma-separated list of systems to build for (default: current system)",
@@ -362,8 +455,13 @@ def _add_common_args(p: argparse.ArgumentParser, *, has_build: bool = True) -> N
         p.add_argument(
             "--max-workers",
             type=int,
-            default=4,
-            help="Maximum number of parallel build workers (default: 4)",
+            default=None,
+            help="Maximum number of parallel build workers (default: CPU count)",
+        )
+        p.add_argument(
+            "--fail-fast",
+            action="store_true",
+            help="Cancel the remaining builds as soon as one build fails",
         )
         p.add_argument(
             "--cachix",
@@ -1,11 +1,57 @@
 """Flake output discovery and comparison."""
 
-import json
+import posixpath
+import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
-from .utils import run_command
+from .cache import get_cache_dir, load_json_cache, save_json_cache
+from .utils import CommandError, get_git_rev, json_dumps, json_loads, run_command
+
+# meta.position is "<store path of the flake source>/<file>:<line>".
+_SOURCE_POSITION_RE = re.compile(r"^/nix/store/[^/]+-source/(.+):\d+$")
+
+
+def _nix_string(text: str) -> str:
+    """Quote text as a Nix string literal.
+
+    JSON string syntax isn't Nix's: Nix has no ``\\uXXXX`` escape, and an
+    unescaped ``${`` starts an interpolation.
+    """
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("${", "\\${")
+    return f'"{escaped}"'
+
+
+def _nix_value(value: Any) -> str:
+    """Nix expression for a JSON-serializable value, passed as data.
+
+    Attribute names are never spliced into the expression as code, so any
+    name round-trips exactly.
+    """
+    return f"(builtins.fromJSON {_nix_string(json_dumps(value))})"
+
+
+def _select_systems(systems: list[str]) -> str:
+    """Nix expression keeping only the given systems of a per-system attrset."""
+    wanted = _nix_value(dict.fromkeys(systems))
+    return f"(builtins.intersectAttrs {wanted} x)"
+
+
+def _select_attrs(names_by_system: dict[str, list[str]]) -> str:
+    """Nix expression keeping only the given names of each given system.
+
+    Nothing else of the per-system attrset is forced, so an unrelated
+    attribute that throws can't fail the evaluation.
+    """
+    wanted = _nix_value(
+        {system: dict.fromkeys(names) for system, names in names_by_system.items()}
+    )
+    return (
+        "(builtins.mapAttrs (s: names: builtins.intersectAttrs names x.${s}) "
+        f"(builtins.intersectAttrs x {wanted}))"
+    )
 
 
 @dataclass
@@ -29,12 +75,45 @@ class ChangeSet:
 
 
 class FlakeOutputs:
-    """Represents the outputs of a flake."""
+    """Represents the outputs of a flake.
+
+    Pass ``immutable=True`` when ``flake_path`` is a clean checkout of a fixed
+    commit (e.g. a GitWorktree). Evaluation results are then cached on disk
+    keyed by the commit SHA. The working tree in local mode must not set it,
+    since its contents can change without the SHA changing.
+    """
 
-    def __init__(self, flake_path: Path):
+    def __init__(self, flake_path: Path, *, immutable: bool = False):
         self.flake_path = flake_path
-        self._outputs: dict[str, Any] | None = None
-        self._derivations: list[DerivationInfo] | None = None
+        self._immutable = immutable
+        self._outputs: dict[str, dict[str, Any] | None] = {}
+        self._derivations: dict[str, DerivationInfo | None] = {}
+        self._drv_cache: dict[str, str] | None = None
+        self._rev = self._resolve_rev() if immutable else None
+
+    def _resolve_rev(self) -> str | None:
+        """Get the commit SHA to key caches on, if evaluation is reproducible.
+
+        Without a flake.lock, Nix resolves inputs freshly on every run, so the
+        same commit can evaluate differently and nothing is cached.
+        """
+        if not (self.flake_path / "flake.lock").exists():
+            return None
+        try:
+            return get_git_rev(self.flake_path)
+        except CommandError:
+            return None
+
+    def _eval_cache_flags(self) -> list[str]:
+        """Extra nix eval flags controlling Nix's own evaluation cache.
+
+        A checkout of a fixed commit can't change under Nix, so its eval
+        cache is safe to use; a working tree may, so it is bypassed there.
+        """
+        return [] if self._immutable else ["--no-eval-cache"]
+
+    def _drv_cache_path(self) -> Path:
+        return get_cache_dir() / "drv-paths" / f"{self._rev}.json"
 
     def _get_raw_outputs(
         self,
@@ -45,67 +124,65 @@ class FlakeOutputs:
         Uses targeted nix eval per output type instead of
         nix flake show --all-systems, which would evaluate
         everything (including devShells that may fail).
+        Each output type is evaluated at most once per instance.
         """
-        if self._outputs is not None:
-            return self._outputs
-
         if output_types is None:
             output_types = ["packages"]
 
-        outputs: dict[str, Any] = {}
-
         for output_type in output_types:
-            try:
-                result = run_command(
-                    [
-                        "nix",
-                        "eval",
-                        "--no-eval-cache",
-                        f"{self.flake_path}#{output_type}",
-                        "--json",
-                        "--apply",
-                        "x: builtins.mapAttrs (_: builtins.attrNames) x",
-                    ],
-                    check=False,
-                )
-                if result.returncode == 0 and result.stdout.strip():
-                    raw = json.loads(result.stdout)
-                    outputs[output_type] = {
-                        system: {name: {"type": "derivation"} for name in names}
-                        for system, names in raw.items()
-                    }
-            except Exception:
+            if output_type in self._outputs:
                 continue
+            raw = self._get_attr_names(output_type)
+            self._outputs[output_type] = (
+                None
+                if raw is None
+                else {
+                    system: {name: {"type": "derivation"} for name in names}
+                    for system, names in raw.items()
+                }
+            )
 
-        self._outputs = outputs
-        return self._outputs
+        return {
+            output_type: outputs
+            for output_type in output_types
+            if (outputs := self._outputs[output_type]) is not None
+        }
 
-    def _traverse_outputs(
-        self,
-        outputs: dict[str, Any],
-        output_type: str,
-        system: str,
-    ) -> list[tuple[str, str]]:
-        """Traverse output structure to find derivations.
+    def _get_attr_names(self, output_type: str) -> dict[str, list[str]] | None:
+        """Get ``{system: [attr names]}`` for an output type.
 
-        Returns list of (name, attr_path) tuples.
+        Cached on disk per (commit, output type) when the flake is immutable.
+        Returns None if the flake has no such output or evaluation fails.
         """
-        results = []
-
-        def recurse(obj: Any, path: list[str]) -> None:
-            if isinstance(obj, dict):
-                if obj.get("type") == "derivation":
-                    name = path[-1] if path else "unknown"
-                    attr_path = f"{output_type}.{system}.{'.'.join(path)}"
-                    results.append((name, attr_path))
-                else:
-                    for key, value in obj.items():
-                        recurse(value, path + [key])
+        cache_path = None
+        if self._rev is not None:
+            cache_path = get_cache_dir() / "outputs" / f"{self._rev}-{output_type}.json"
+            cached = load_json_cache(cache_path)
+            if isinstance(cached, dict):
+                return cached
 
-        if output_type in outputs and system in outputs[output_type]:
-            recurse(outputs[output_type][system], [])
+        try:
+            result = run_command(
+                [
+                    "nix",
+                    "eval",
+                    *self._eval_cache_flags(),
+                    f"{self.flake_path}#{output_type}",
+                    "--json",
+                    "--apply",
+                    "x: builtins.mapAttrs (_: builtins.attrNames) x",
+                ],
+                check=False,
+            )
+            if result.returncode != 0 or not result.stdout.strip():
+                return None
+            raw: dict[str, list[str]] = json_loads(result.stdout)
+        except Exception:
+            return None
 
-        return results
+        if cache_path is not None:
+            save_json_cache(cache_path, raw)
+        return raw
 
     def get_derivations(
         self,
@@ -115,19 +192,14 @@ class FlakeOutputs:
     ) -> list[DerivationInfo]:
         """Get all derivations from the flake.
 
+        Derivations are memoized per attribute, so repeated or narrower
+        queries are answered without running nix eval again.
+
         Args:
             output_types: List of output types to include (default: ["packages"])
             systems: List of systems to include (default: all found systems)
             package_filter: List of package names to include (default: all)
         """
-        if (
-            self._derivations is not None
-            and output_types is None
-            and systems is None
-            and package_filter is None
-        ):
-            return self._derivations
-
         if output_types is None:
             output_types = ["packages"]
 
@@ -140,48 +212,198 @@ class FlakeOutputs:
                     systems_set.update(raw_outputs[output_type].keys())
             systems = list(systems_set)
 
-        derivations = []
+        derivations: list[DerivationInfo] = []
 
         for output_type in output_types:
             if output_type not in raw_outputs:
                 continue
 
-            for system in systems:
-                if system not in raw_outputs[output_type]:
-                    continue
+            # Outputs are exactly two levels deep ({system: {name: ...}}),
+            # so the attribute names can be read off directly.
+            attrs = [
+                (system, name, f"{output_type}.{system}.{name}")
+                for system in systems
+                if system in raw_outputs[output_type]
+                for name in raw_outputs[output_type][system]
+                if package_filter is None or name in package_filter
+            ]
+
+            pending = [attr for attr in attrs if attr[2] not in self._derivations]
+            if pending:
+                self._resolve_derivations(output_type, pending)
+
+            derivations.extend(
+                drv
+                for _, _, attr_path in attrs
+                if (drv := self._derivations[attr_path]) is not None
+            )
 
-                attr_list = self._traverse_outputs(raw_outputs, output_type, system)
+        return derivations
 
-                for name, attr_path in attr_list:
-                    if package_filter is not None and name not in package_filter:
-                        continue
+    def _resolve_derivations(
+        self, output_type: str, attrs: list[tuple[str, str, str]]
+    ) -> None:
+        """Evaluate and memoize ``(system, name, attr_path)`` attributes."""
+        cached = self._load_drv_cache() or {}
+        uncached: dict[str, list[str]] = {}
+        for system, name, attr_path in attrs:
+            if attr_path not in cached:
+                uncached.setdefault(system, []).append(name)
+        bulk: dict[str, str] = {}
+        if sum(map(len, uncached.values())) > 1:
+            bulk = self._get_all_drv_paths(output_type, uncached)
+            self._store_drv_paths(bulk)
+
+        for system, name, attr_path in attrs:
+            drv_path = bulk.get(attr_path) or self._get_derivation_path(attr_path)
+            self._derivations[attr_path] = (
+                DerivationInfo(
+                    attr_path=attr_path,
+                    drv_path=drv_path,
+                    output_type=output_type,
+                    system=system,
+                    name=name,
+                )
+                if drv_path
+                else None
+            )
 
-                    drv_path = self._get_derivation_path(attr_path)
+    def _load_drv_cache(self) -> dict[str, str] | None:
+        """Get the on-disk drvPath cache, or None if this flake isn't cacheable."""
+        if self._rev is None:
+            return None
+        if self._drv_cache is None:
+            cached = load_json_cache(self._drv_cache_path())
+            self._drv_cache = cached if isinstance(cached, dict) else {}
+        return self._drv_cache
+
+    def _store_drv_paths(self, drv_paths: dict[str, str]) -> None:
+        """Write drvPaths through to the on-disk cache."""
+        cache = self._load_drv_cache()
+        if cache is None or not drv_paths:
+            return
+        cache.update(drv_paths)
+        save_json_cache(self._drv_cache_path(), cache)
+
+    def _get_all_drv_paths(
+        self, output_type: str, names_by_system: dict[str, list[str]]
+    ) -> dict[str, str]:
+        """Evaluate the drvPath of the named attributes of each system.
+
+        All systems share one nix eval instead of one per attribute (or per
+        system), so evaluator startup and the flake's inputs are paid once;
+        only the requested attributes are evaluated.
+        Returns ``{attr_path: drv_path}``. If the combined evaluation fails
+        it is retried per system; a system that still fails (e.g. a single
+        attribute throws) is left out and callers fall back to per-attribute
+        evaluation.
+        """
+        drv_paths = self._eval_drv_paths(output_type, names_by_system)
+        if drv_paths is not None:
+            return drv_paths
+        if len(names_by_system) <= 1:
+            return {}
+        result: dict[str, str] = {}
+        for system, names in names_by_system.items():
+            result.update(self._get_all_drv_paths(output_type, {system: names}))
+        return result
+
+    def _eval_drv_paths(
+        self, output_type: str, names_by_system: dict[str, list[str]]
+    ) -> dict[str, str] | None:
+        """Run the bulk drvPath eval for the named attributes; None if it fails."""
+        try:
+            result = run_command(
+                [
+                    "nix",
+                    "eval",
+                    *self._eval_cache_flags(),
+                    f"{self.flake_path}#{output_type}",
+                    "--json",
+                    "--apply",
+                    "x: builtins.mapAttrs (_: builtins.mapAttrs (_: v: v.drvPath)) "
+                    + _select_attrs(names_by_system),
+                ],
+                check=False,
+            )
+            if result.returncode != 0 or not result.stdout.strip():
+                return None
+            raw = json_loads(result.stdout)
+        except Exception:
+            return None
+        if not isinstance(raw, dict):
+            return None
+        return {
+            f"{output_type}.{system}.{name}": drv_path
+            for system, names in names_by_system.items()
+            if isinstance(raw.get(system), dict)
+            for name in names
+            if isinstance(drv_path := raw[system].get(name), str)
+        }
+
+    def get_source_positions(
+        self, output_type: str, systems: list[str]
+    ) -> dict[str, str]:
+        """Get ``{attr name: file}`` from each attribute's ``meta.position``.
+
+        Files are relative to the flake root. Attributes without a position,
+        or whose position lies outside the flake (e.g. re-exported nixpkgs
+        packages), are left out.
+        """
+        try:
+            result = run_command(
+                [
+                    "nix",
+                    "eval",
+                    *self._eval_cache_flags(),
+                    f"{self.flake_path}#{output_type}",
+                    "--json",
+                    "--apply",
+                    "x: builtins.mapAttrs (_: builtins.mapAttrs (_: p: "
+                    "let r = builtins.tryEval (p.meta.position or null); "
+                    "in if r.success then r.value else null)) "
+                    + _select_systems(systems),
+                ],
+                check=False,
+            )
+            if result.returncode != 0 or not result.stdout.strip():
+                return {}
+            raw = json_loads(result.stdout)
+        except Exception:
+            return {}
 
-                    if drv_path:
-                        derivations.append(
-                            DerivationInfo(
-                                attr_path=attr_path,
-                                drv_path=drv_path,
-                                output_type=output_type,
-                                system=system,
-                                name=name,
-                            )
-                        )
+        positions: dict[str, str] = {}
+        for attrs in raw.values() if isinstance(raw, dict) else ():
+            for name, position in attrs.items():
+                match = _SOURCE_POSITION_RE.match(position or "")
+                if match:
+                    positions.setdefault(name, match.group(1))
+        return positions
 
-        if output_types == ["packages"] and systems is None and package_filter is None:
-            self._derivations = derivations
+    def _get_derivation_path(self, attr_path: str) -> str | None:
+        """Get the derivation store path for a flake attribute.
 
-        return derivations
+        Results are cached on disk per commit when the flake is immutable.
+        """
+        cache = self._load_drv_cache()
+        if cache is not None and attr_path in cache:
+            return cache[attr_path]
 
-    def _get_derivation_path(self, attr_path: str) -> str | None:
-        """Get the derivation store path for a flake attribute."""
+        drv_path = self._eval_derivation_path(attr_path)
+
+        if drv_path:
+            self._store_drv_paths({attr_path: drv_path})
+
+        return drv_path
+
+    def _eval_derivation_path(self, attr_path: str) -> str | None:
+        """Evaluate the derivation store path for a flake attribute."""
         try:
             result = run_command(
                 [
                     "nix",
                     "eval",
-                    "--no-eval-cache",
+                    *self._eval_cache_flags(),
                     f"{self.flake_path}#{attr_path}.drvPath",
                     "--raw",
                 ],
@@ -194,6 +416,29 @@ class FlakeOutputs:
             return None
 
 
+def packages_owning_files(
+    positions: dict[str, str], changed_files: list[str]
+) -> list[str] | None:
+    """Pick the packages a set of changed files can belong to.
+
+    A file belongs to a package if it lives under the directory of the
+    package's ``meta.position`` file. Returns None, meaning "review
+    everything", if flake.nix or flake.lock changed or any changed file has
+    no owning package, since the effect of such changes can't be scoped.
+    """
+    if not changed_files or {"flake.nix", "flake.lock"} & set(changed_files):
+        return None
+
+    dirs = {name: posixpath.dirname(path) for name, path in positions.items()}
+    selected: set[str] = set()
+    for path in changed_files:
+        owners = {name for name, d in dirs.items() if not d or path.startswith(f"{d}/")}
+        if not owners:
+            return None
+        selected |= owners
+    return sorted(selected)
+
+
 def compare_outputs(
     base: FlakeOutputs,
     target: FlakeOutputs,
@@ -210,24 +455,29 @@ def compare_outputs(
         systems: List of systems to compare (default: all systems)
         package_filter: List of package names to include (default: all)
     """
-    base_derivations = base.get_derivations(output_types, systems, package_filter)
-    target_derivations = target.get_derivations(output_types, systems, package_filter)
+    # Both sides spend their time waiting on independent nix eval
+    # subprocesses, so evaluate them concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        base_future = executor.submit(
+            base.get_derivations, output_types, systems, package_filter
+        )
+        target_future = executor.submit(
+            target.get_derivations, output_types, systems, package_filter
+        )
+        base_derivations = base_future.result()
+        target_derivations = target_future.result()
 
     base_map = {drv.attr_path: drv for drv in base_derivations}
     target_map = {drv.attr_path: drv for drv in target_derivations}
 
-    added = []
-    removed = []
-    modified = []
-
-    for attr_path, target_drv in target_map.items():
-        if attr_path not in base_map:
-            added.append(target_drv)
-        elif base_map[attr_path].drv_path != target_drv.drv_path:
-            modified.append((base_map[attr_path], target_drv))
-
-    for attr_path, base_drv in base_map.items():
-        if attr_path not in target_map:
-            removed.append(base_drv)
+    # Key-view set operations run in C; sort so the report order is
+    # deterministic rather than depending on evaluation order.
+    added = [target_map[key] for key in sorted(target_map.keys() - base_map.keys())]
+    removed = [base_map[key] for key in sorted(base_map.keys() - target_map.keys())]
+    modified = [
+        (base_map[key], target_map[key])
+        for key in sorted(base_map.keys() & target_map.keys())
+        if base_map[key].drv_path != target_map[key].drv_path
+    ]
 
     return ChangeSet(added=added, removed=removed, modified=modified)
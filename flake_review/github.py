@@ -1,13 +1,27 @@
 """GitHub API integration for posting results to PRs."""
 
+import base64
 import json
 import os
 import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from http.client import HTTPMessage, HTTPResponse, HTTPSConnection, RemoteDisconnected
 from typing import Any
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+from urllib.parse import unquote, urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+from .cache import get_cache_dir, load_json_cache, save_json_cache
+
+
+class GithubAPIError(RuntimeError):
+    """A GitHub API request returned an error status."""
+
+    def __init__(self, status: int, reason: str, body: str):
+        self.status = status
+        super().__init__(f"GitHub API error: {status} {reason}\n{body}")
 
 
 @dataclass
@@ -45,7 +59,23 @@ class GithubClient:
     """Client for interacting with GitHub API."""
 
     _COMMENT_MARKER = "<!-- flake-review -->"
+    # The marker text minus the HTML delimiters, which a JSON encoder may
+    # escape; if this isn't in a raw response the marker can't be either
+    _COMMENT_MARKER_TEXT = b"-- flake-review --"
     _MAX_COMMENT_BODY_LENGTH = 65536
+    # The next-page entry of a paginated response's Link header
+    _NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+    # One keep-alive connection per host and thread, shared by every client,
+    # so each API call after the first skips the TCP + TLS handshake.
+    # HTTPSConnection isn't thread-safe, hence one set per thread.
+    _local = threading.local()
+    _TIMEOUT = 30  # seconds, per socket operation
+    # Renamed or transferred repositories answer with a redirect
+    _REDIRECT_STATUSES = frozenset({301, 302, 307, 308})
+    _MAX_REDIRECTS = 3
+    # Methods that are safe to resend when the connection drops mid-request
+    _RETRYABLE_METHODS = frozenset({"GET", "HEAD", "PATCH"})
 
     def __init__(self, token: str | None = None):
         self.token = (
@@ -58,6 +88,38 @@ class GithubClient:
                 "or authenticate with `gh auth login`"
             )
 
+        # Static request headers, shared by every call that adds none of its own
+        self._headers = {
+            "Authorization": f"token {self.token}",
+            "Accept": "application/vnd.github.v3+json",
+            "User-Agent": "flake-review",
+        }
+
+        # Marker comment ids already looked up, keyed by (owner, repo, number)
+        self._marker_comments: dict[tuple[str, str, int], int | None] = {}
+
+    def __enter__(self) -> "GithubClient":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
+        self.close()
+
+    @classmethod
+    def close(cls) -> None:
+        """Close this thread's shared connections; later requests reconnect."""
+        for host in list(cls._connections()):
+            cls._drop_connection(host)
+
+    @classmethod
+    def _connections(cls) -> dict[str, HTTPSConnection]:
+        """This thread's connections, keyed by host."""
+        connections: dict[str, HTTPSConnection] | None = getattr(
+            cls._local, "connections", None
+        )
+        if connections is None:
+            connections = cls._local.connections = {}
+        return connections
+
     def _get_token_from_env(self) -> str | None:
         """Get GitHub token from environment."""
         return os.environ.get("GITHUB_TOKEN")
@@ -75,33 +137,232 @@ class GithubClient:
         except (subprocess.CalledProcessError, FileNotFoundError):
             return None
 
-    def _make_request(
+    @classmethod
+    def _get_connection(cls, host: str) -> HTTPSConnection:
+        """Return the shared connection to host, opening it on first use."""
+        conn = cls._connections().get(host)
+        if conn is None:
+            proxy = getproxies().get("https")
+            if proxy and not proxy_bypass(host):
+                parts = urlsplit(proxy)
+                conn = HTTPSConnection(
+                    parts.hostname or proxy, parts.port, timeout=cls._TIMEOUT
+                )
+                # Credentials in the proxy URL authenticate the CONNECT, as
+                # urllib's ProxyHandler does
+                tunnel_headers = {}
+                if parts.username is not None:
+                    user = unquote(parts.username)
+                    password = unquote(parts.password or "")
+                    token = base64.b64encode(f"{user}:{password}".encode()).decode()
+                    tunnel_headers["Proxy-Authorization"] = f"Basic {token}"
+                conn.set_tunnel(host, headers=tunnel_headers)
+            else:
+                conn = HTTPSConnection(host, timeout=cls._TIMEOUT)
+            cls._connections()[host] = conn
+        return conn
+
+    @classmethod
+    def _drop_connection(cls, host: str) -> None:
+        """Close and forget the shared connection to host."""
+        conn = cls._connections().pop(host, None)
+        if conn is not None:
+            conn.close()
+
+    def _send(
+        self,
+        host: str,
+        method: str,
+        path: str,
+        body: bytes | None,
+        headers: dict[str, str],
+    ) -> tuple[HTTPResponse, bytes]:
+        """Send a request over the shared connection to host.
+
+        GitHub closes idle keep-alive connections, so a request that finds
+        its connection dropped is retried once on a fresh one. Only
+        idempotent methods are retried: the server may have acted on a
+        request before dropping the connection, and a repeated POST would
+        post the comment twice.
+        """
+        try:
+            return self._send_once(host, method, path, body, headers)
+        except (RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            if method not in self._RETRYABLE_METHODS:
+                raise
+            return self._send_once(host, method, path, body, headers)
+
+    def _send_once(
+        self,
+        host: str,
+        method: str,
+        path: str,
+        body: bytes | None,
+        headers: dict[str, str],
+    ) -> tuple[HTTPResponse, bytes]:
+        conn = self._get_connection(host)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response, response.read()
+        except Exception:
+            self._drop_connection(host)
+            raise
+
+    def _request(
         self,
         url: str,
         method: str = "GET",
         data: dict[str, Any] | None = None,
-    ) -> Any:
-        """Make an authenticated GitHub API request."""
-        headers = {
-            "Authorization": f"token {self.token}",
-            "Accept": "application/vnd.github.v3+json",
-        }
-
+        extra_headers: dict[str, str] | None = None,
+        raw: bool = False,
+    ) -> tuple[int, HTTPMessage, Any]:
+        """Make an authenticated GitHub API request.
+
+        Returns ``(status, response headers, decoded JSON body)``, or the
+        undecoded body bytes with ``raw``. Redirects to the same host are
+        followed with the same method and body. Error statuses and any other
+        redirect raise; 304 Not Modified is returned with a None (or empty)
+        body.
+        """
+        headers = self._headers
         request_data = None
         if data is not None:
             request_data = json.dumps(data).encode("utf-8")
-            headers["Content-Type"] = "application/json"
+            headers = {**headers, "Content-Type": "application/json"}
+        if extra_headers:
+            headers = {**headers, **extra_headers}
+
+        host = urlsplit(url).netloc
+        for _ in range(self._MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+            response, body = self._send(host, method, path, request_data, headers)
+            location = response.headers.get("Location")
+            if response.status not in self._REDIRECT_STATUSES or not location:
+                break
+            url = urljoin(url, location)
+            # Never send the token anywhere but the host it was meant for
+            if urlsplit(url).netloc != host:
+                break
+
+        if response.status >= 300 and response.status != 304:
+            raise GithubAPIError(response.status, response.reason, body.decode("utf-8"))
+        if raw:
+            return response.status, response.headers, body
+        payload = json.loads(body.decode("utf-8")) if body else None
+        return response.status, response.headers, payload
 
-        req = Request(url, data=request_data, headers=headers, method=method)
+    def _make_request(
+        self,
+        url: str,
+        method: str = "GET",
+        data: dict[str, Any] | None = None,
+    ) -> Any:
+        """Make an authenticated GitHub API request and return its JSON body."""
+        return self._request(url, method, data)[2]
+
+    _PR_QUERY = """
+    query($owner: String!, $repo: String!, $number: Int!) {
+      repository(owner: $owner, name: $repo) {
+        pullRequest(number: $number) {
+          baseRefName baseRefOid headRefName headRefOid
+          headRepository { nameWithOwner url }
+          comments(first: 100) {
+            pageInfo { hasNextPage }
+            nodes { databaseId body }
+          }
+        }
+      }
+    }
+    """
 
+    def get_pr_and_marker_comment(
+        self, owner: str, repo: str, number: int
+    ) -> tuple[PullRequest, int | None]:
+        """Fetch a PR and its flake-review comment id in one GraphQL call.
+
+        Replaces the separate REST requests for the PR and its comments, for
+        callers that post straight away. The comment id is remembered for
+        ``post_comment``. The bot's comment is updated in place, so it keeps
+        its early spot in the thread; the query covers the first 100
+        comments, and a longer thread without the marker among them is
+        searched in full over REST. Falls back to REST entirely if GraphQL
+        is unavailable.
+        """
         try:
-            with urlopen(req) as response:
-                return json.loads(response.read().decode("utf-8"))
-        except HTTPError as e:
-            error_body = e.read().decode("utf-8")
-            raise RuntimeError(
-                f"GitHub API error: {e.code} {e.reason}\n{error_body}"
-            ) from e
+            data = self._make_request(
+                "https://api.github.com/graphql",
+                method="POST",
+                data={
+                    "query": self._PR_QUERY,
+                    "variables": {"owner": owner, "repo": repo, "number": number},
+                },
+            )
+            if data.get("errors"):
+                raise RuntimeError(f"GitHub GraphQL error: {data['errors']}")
+            pr_data = data["data"]["repository"]["pullRequest"]
+        except Exception:
+            return self._get_pr_and_marker_comment_rest(owner, repo, number)
+
+        base_ref = pr_data["baseRefName"]
+        head_repo_url = None
+        head_repo = pr_data["headRepository"]
+        if head_repo and head_repo["nameWithOwner"] != f"{owner}/{repo}":
+            head_repo_url = f"{head_repo['url']}.git"
+            head_owner = head_repo["nameWithOwner"].split("/")[0]
+            head_label = f"{head_owner}:{pr_data['headRefName']}"
+            print(f"Fork PR: {head_label} -> {owner}/{repo}:{base_ref}")
+
+        comment_id = None
+        comments = pr_data["comments"]
+        for comment in comments["nodes"]:
+            if self._COMMENT_MARKER in (comment.get("body") or ""):
+                comment_id = int(comment["databaseId"])
+                break
+        if comment_id is None and comments["pageInfo"]["hasNextPage"]:
+            # Left uncached on failure, so post_comment looks again
+            try:
+                comment_id = self._find_marker_comment(owner, repo, number)
+            except Exception:
+                pass
+        else:
+            self._marker_comments[(owner, repo, number)] = comment_id
+
+        pr = PullRequest(
+            owner=owner,
+            repo=repo,
+            number=number,
+            base_ref=base_ref,
+            base_sha=pr_data["baseRefOid"],
+            head_ref=pr_data["headRefName"],
+            head_sha=pr_data["headRefOid"],
+            head_repo_url=head_repo_url,
+        )
+        return pr, comment_id
+
+    def _get_pr_and_marker_comment_rest(
+        self, owner: str, repo: str, number: int
+    ) -> tuple[PullRequest, int | None]:
+        """Fetch the PR and look up its comment over REST, concurrently.
+
+        The two GETs are independent, so the comment lookup runs on a worker
+        thread (with its own connection) while the PR is fetched. If the
+        lookup fails, it is retried lazily by ``post_comment``.
+        """
+
+        def lookup() -> int | None:
+            try:
+                return self._find_marker_comment(owner, repo, number)
+            except Exception:
+                return None
+            finally:
+                self.close()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            comment = executor.submit(lookup)
+            pr = self.get_pull_request(owner, repo, number)
+            return pr, comment.result()
 
     def get_pull_request(self, owner: str, repo: str, number: int) -> PullRequest:
         """Fetch pull request information from GitHub."""
@@ -188,13 +449,79 @@ class GithubClient:
 
     def _find_existing_comment(self, pr: PullRequest) -> int | None:
         """Find an existing flake-review comment on a PR."""
-        url = f"https://api.github.com/repos/{pr.owner}/{pr.repo}/issues/{pr.number}/comments"
-        comments = self._make_request(url)
-        for comment in comments:
+        return self._find_marker_comment(pr.owner, pr.repo, pr.number)
+
+    def _find_marker_comment(self, owner: str, repo: str, number: int) -> int | None:
+        """Find the flake-review comment on PR ``owner/repo#number``.
+
+        Comments are paged through 100 at a time until the marker turns up.
+        The first page's ETag and the id found are cached on disk when that
+        page settles the answer (the marker is on it, or it is the only
+        page), so a repeat run against an unchanged PR gets an empty 304
+        back (which also doesn't count against the rate limit) instead of
+        every comment.
+        """
+        known = (owner, repo, number)
+        if known in self._marker_comments:
+            return self._marker_comments[known]
+
+        url = (
+            f"https://api.github.com/repos/{owner}/{repo}/issues/{number}/comments"
+            "?per_page=100"
+        )
+        etag_path = get_cache_dir() / "etags.json"
+        key = f"{owner}/{repo}#{number}"
+        etags = load_json_cache(etag_path)
+        if not isinstance(etags, dict):
+            etags = {}
+        cached = etags.get(key)
+
+        headers = {}
+        if isinstance(cached, dict) and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        status, response_headers, body = self._request(
+            url, extra_headers=headers, raw=True
+        )
+        comment_id = None
+        if status == 304 and isinstance(cached, dict):
+            if cached.get("comment_id") is not None:
+                comment_id = int(cached["comment_id"])
+        else:
+            comment_id = self._find_marker_in_page(body)
+            next_url = self._next_page_url(response_headers)
+            settled = comment_id is not None or next_url is None
+            while comment_id is None and next_url is not None:
+                _, page_headers, page = self._request(next_url, raw=True)
+                comment_id = self._find_marker_in_page(page)
+                next_url = self._next_page_url(page_headers)
+
+            etag = response_headers.get("ETag")
+            if etag and settled:
+                etags[key] = {"etag": etag, "comment_id": comment_id}
+                save_json_cache(etag_path, etags)
+            elif etags.pop(key, None) is not None:
+                save_json_cache(etag_path, etags)
+
+        self._marker_comments[known] = comment_id
+        return comment_id
+
+    def _find_marker_in_page(self, body: bytes) -> int | None:
+        """Find the flake-review comment in one raw page of issue comments."""
+        # Only decode the page if the marker can be somewhere in it
+        if self._COMMENT_MARKER_TEXT not in body:
+            return None
+        for comment in json.loads(body):
             if self._COMMENT_MARKER in comment.get("body", ""):
                 return int(comment["id"])
         return None
 
+    @classmethod
+    def _next_page_url(cls, headers: HTTPMessage) -> str | None:
+        """Get the ``rel="next"`` URL from a response's Link header, if any."""
+        match = cls._NEXT_LINK_RE.search(headers.get("Link") or "")
+        return match.group(1) if match else None
+
     def post_comment(self, pr: PullRequest, body: str) -> None:
         """Post or update a flake-review comment on a pull request."""
         safe_body = self._truncate_comment_body(body)
@@ -203,10 +530,27 @@ class GithubClient:
         existing_id = self._find_existing_comment(pr)
         if existing_id:
             url = f"https://api.github.com/repos/{pr.owner}/{pr.repo}/issues/comments/{existing_id}"
-            self._make_request(url, method="PATCH", data={"body": body_with_marker})
-        else:
-            url = f"https://api.github.com/repos/{pr.owner}/{pr.repo}/issues/{pr.number}/comments"
-            self._make_request(url, method="POST", data={"body": body_with_marker})
+            try:
+                self._make_request(url, method="PATCH", data={"body": body_with_marker})
+                return
+            except GithubAPIError as e:
+                # The remembered comment may have been deleted since; post anew.
+                if e.status != 404:
+                    raise
+        url = f"https://api.github.com/repos/{pr.owner}/{pr.repo}/issues/{pr.number}/comments"
+        created = self._make_request(
+            url, method="POST", data={"body": body_with_marker}
+        )
+        if isinstance(created, dict) and "id" in created:
+            self._marker_comments[(pr.owner, pr.repo, pr.number)] = int(created["id"])
+
+
+# Anchored so trailing garbage is rejected; a full URL may still point below
+# the PR (…/pull/123/files, …#issuecomment-1).
+_FULL_PR_URL_RE = re.compile(
+    r"\Ahttps://github\.com/([^/]+)/([^/]+)/pulls?/(\d+)(?:[/?#].*)?\Z"
+)
+_SHORT_PR_URL_RE = re.compile(r"\A([^/]+)/([^#]+)#(\d+)\Z")
 
 
 def parse_pr_url(url: str) -> tuple[str, str, int]:
@@ -218,12 +562,12 @@ def parse_pr_url(url: str) -> tuple[str, str, int]:
     - owner/repo#123
     """
     # Try full URL format
-    match = re.match(r"https://github\.com/([^/]+)/([^/]+)/pulls?/(\d+)", url)
+    match = _FULL_PR_URL_RE.match(url)
     if match:
         return match.group(1), match.group(2), int(match.group(3))
 
     # Try short format
-    match = re.match(r"([^/]+)/([^#]+)#(\d+)", url)
+    match = _SHORT_PR_URL_RE.match(url)
     if match:
         return match.group(1), match.group(2), int(match.group(3))
 
@@ -1,14 +1,21 @@
 """Generate reports for build results."""
 
-import json
+import functools
+import io
+import itertools
 import os
 import re
 import subprocess
 import sys
+import threading
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from typing import Any
 
 from .build import BuildResult, BuildResults
 from .flake import ChangeSet, DerivationInfo
+from .utils import json_loads, tail_lines
 
 _ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
 
@@ -20,8 +27,49 @@ def _strip_ansi(text: str | None) -> str | None:
     return _ANSI_ESCAPE_RE.sub("", text)
 
 
+@functools.cache
+def _nix_diff_env() -> dict[str, str]:
+    """Environment for nix-diff, built once and shared by every call.
+
+    NIX_REMOTE="" forces local store access, avoiding daemon protocol
+    issues where nix-diff can't read .drv files.
+    """
+    return {**os.environ, "NIX_REMOTE": ""}
+
+
+# nix-diff output past this is too long to read in a report anyway.
+_NIX_DIFF_MAX_LINES = 5000
+_NIX_DIFF_TIMEOUT = 60  # seconds
+
+
+# Successful diffs by (old, new) pair. .drv paths are content-addressed, so
+# a pair always diffs the same; failures and timeouts are retried instead.
+_nix_diffs: dict[tuple[str, str], str] = {}
+
+
 def _get_nix_diff(old_drv: str, new_drv: str) -> str | None:
-    """Run nix-diff between two derivations."""
+    """Run nix-diff between two derivations.
+
+    Memoized on success, so the console, JSON and markdown reports can
+    share one run per pair.
+    """
+    key = (old_drv, new_drv)
+    if key in _nix_diffs:
+        return _nix_diffs[key]
+    diff, complete = _run_nix_diff(old_drv, new_drv)
+    if diff is not None and complete:
+        _nix_diffs[key] = diff
+    return diff
+
+
+def _run_nix_diff(old_drv: str, new_drv: str) -> tuple[str | None, bool]:
+    """Run nix-diff once; returns the diff and whether the run completed.
+
+    Output is streamed and cut off at ``_NIX_DIFF_MAX_LINES`` lines rather
+    than buffered whole, and nix-diff is killed if it runs too long. stderr
+    is drained on a separate thread so a chatty nix-diff can't block on a
+    full pipe.
+    """
     try:
         cmd = [
             "nix-diff",
@@ -31,30 +79,59 @@ def _get_nix_diff(old_drv: str, new_drv: str) -> str | None:
             old_drv,
             new_drv,
         ]
-        # NIX_REMOTE="" forces local store access, avoiding daemon
-        # protocol issues where nix-diff can't read .drv files
-        env = {**os.environ, "NIX_REMOTE": ""}
-        result = subprocess.run(
+        timed_out = threading.Event()
+        with subprocess.Popen(
             cmd,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            check=False,
-            env=env,
-        )
-        if result.stdout.strip():
-            return result.stdout.strip()
-        if result.stderr.strip():
+            env=_nix_diff_env(),
+        ) as proc:
+            assert proc.stdout is not None and proc.stderr is not None
+            stderr_stream = proc.stderr
+            stderr_parts: list[str] = []
+            stderr_reader = threading.Thread(
+                target=lambda: stderr_parts.append(stderr_stream.read()),
+                daemon=True,
+            )
+            stderr_reader.start()
+
+            def kill() -> None:
+                timed_out.set()
+                proc.kill()
+
+            timer = threading.Timer(_NIX_DIFF_TIMEOUT, kill)
+            timer.start()
+            try:
+                lines = list(itertools.islice(proc.stdout, _NIX_DIFF_MAX_LINES))
+                truncated = proc.stdout.readline() != ""
+                if truncated:
+                    proc.kill()
+                stderr_reader.join()
+            finally:
+                timer.cancel()
+        stderr = "".join(stderr_parts)
+
+        diff = "".join(lines).strip()
+        if timed_out.is_set():
+            print(f"nix-diff timed out after {_NIX_DIFF_TIMEOUT}s", file=sys.stderr)
+            truncated = bool(diff)
+        if diff:
+            if truncated:
+                diff += f"\n... (nix-diff output truncated after {len(lines)} lines)"
+            return diff, not timed_out.is_set()
+        if stderr.strip():
             print(
-                f"nix-diff failed: {result.stderr.strip()[:200]}",
+                f"nix-diff failed: {stderr.strip()[:200]}",
                 file=sys.stderr,
             )
-        return None
+        return None, False
     except FileNotFoundError:
         print("nix-diff not found on PATH", file=sys.stderr)
-        return None
+        return None, False
     except Exception as e:
         print(f"nix-diff error: {e}", file=sys.stderr)
-        return None
+        return None, False
 
 
 def _diff_key(old_drv: str, new_drv: str) -> tuple[str, str]:
@@ -63,13 +140,25 @@ def _diff_key(old_drv: str, new_drv: str) -> tuple[str, str]:
 
 
 def collect_nix_diffs(changes: ChangeSet) -> dict[tuple[str, str], str | None]:
-    """Compute nix-diff once per modified derivation pair."""
-    diffs: dict[tuple[str, str], str | None] = {}
-    for old, new in changes.modified:
-        key = _diff_key(old.drv_path, new.drv_path)
-        if key not in diffs:
-            diffs[key] = _get_nix_diff(old.drv_path, new.drv_path)
-    return diffs
+    """Compute nix-diff once per modified derivation pair.
+
+    Each pair is an independent nix-diff subprocess, so they run in
+    parallel threads.
+    """
+    keys = list(
+        dict.fromkeys(
+            _diff_key(old.drv_path, new.drv_path) for old, new in changes.modified
+        )
+    )
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 4)) as executor:
+        return dict(zip(keys, executor.map(lambda key: _get_nix_diff(*key), keys)))
+
+
+def _indent(text: str, prefix: str) -> str:
+    """Prefix every line of text, blank ones included, in one pass."""
+    return prefix + text.replace("\n", f"\n{prefix}")
 
 
 def _format_diff_section(
@@ -77,51 +166,51 @@ def _format_diff_section(
     markdown: bool,
     *,
     markdown_ansi: bool = False,
-) -> list[str]:
-    """Format nix-diff output."""
+) -> Sequence[str]:
+    """Format nix-diff output.
+
+    Returns an empty tuple when there is no diff, the common case.
+    """
     if not diff:
-        return []
-    lines: list[str] = []
-    if markdown:
-        rendered_diff = diff if markdown_ansi else (_strip_ansi(diff) or "")
-        lines.append("  <details>")
-        lines.append("  <summary>Derivation diff</summary>\n")
-        lines.append("  ```diff")
-        for diff_line in rendered_diff.split("\n"):
-            lines.append(f"  {diff_line}")
-        lines.append("  ```\n")
-        lines.append("  </details>")
-    else:
-        for diff_line in diff.split("\n"):
-            lines.append(f"    {diff_line}")
-    return lines
-
-
-def _format_build_error(error: str, markdown: bool) -> list[str]:
+        return ()
+    if not markdown:
+        return [_indent(diff, "    ")]
+
+    rendered_diff = diff if markdown_ansi else (_strip_ansi(diff) or "")
+    return [
+        "  <details>",
+        "  <summary>Derivation diff</summary>\n",
+        "  ```diff",
+        _indent(rendered_diff, "  "),
+        "  ```\n",
+        "  </details>",
+    ]
+
+
+def _format_build_error(error: str | None, markdown: bool) -> Sequence[str]:
     """Format a build error for display.
 
     For markdown, uses a collapsible <details> block with the full error.
-    For console, shows the last 20 lines.
+    For console, shows the last 20 lines. Returns an empty tuple when
+    there is nothing to show.
     """
-    lines: list[str] = []
-    error_lines = [line for line in error.strip().split("\n") if line.strip()]
-    if not error_lines:
-        return lines
+    if not error or error.isspace():
+        return ()
 
-    if markdown:
-        lines.append("  <details>")
-        lines.append("  <summary>Build error</summary>\n")
-        lines.append("  ```")
-        for err_line in error_lines:
-            lines.append(f"  {err_line}")
-        lines.append("  ```\n")
-        lines.append("  </details>")
-    else:
-        tail = error_lines[-20:]
-        for err_line in tail:
-            lines.append(f"    {err_line}")
+    if not markdown:
+        tail = tail_lines(io.StringIO(error), 20)
+        return [_indent("\n".join(tail), "    ")]
 
-    return lines
+    error_lines = [line for line in error.strip().split("\n") if line.strip()]
+
+    return [
+        "  <details>",
+        "  <summary>Build error</summary>\n",
+        "  ```",
+        _indent("\n".join(error_lines), "  "),
+        "  ```\n",
+        "  </details>",
+    ]
 
 
 def format_detailed_changes(
@@ -134,7 +223,7 @@ def format_detailed_changes(
     """Format detailed changes with build results."""
     lines: list[str] = []
 
-    result_map = {r.derivation.attr_path: r for r in results.results}
+    result_map = results.by_attr_path
 
     if changes.added:
         lines.append(f"### ➕ Added ({len(changes.added)})\n")
@@ -153,6 +242,8 @@ def format_detailed_changes(
         lines.append("")
 
     if changes.modified:
+        if nix_diffs is None:
+            nix_diffs = collect_nix_diffs(changes)
         lines.append(f"### 🔄 Modified ({len(changes.modified)})\n")
         for old, new in changes.modified:
             result = result_map.get(new.attr_path)
@@ -167,10 +258,7 @@ def format_detailed_changes(
             else:
                 lines.append(f"- `{new.attr_path}`")
 
-            if nix_diffs is not None:
-                diff = nix_diffs.get(_diff_key(old.drv_path, new.drv_path))
-            else:
-                diff = _get_nix_diff(old.drv_path, new.drv_path)
+            diff = nix_diffs.get(_diff_key(old.drv_path, new.drv_path))
             lines.extend(
                 _format_diff_section(
                     diff,
@@ -194,7 +282,7 @@ def generate_markdown_report(
     results: BuildResults,
     title: str = "Flake Review Results",
     requested_systems: list[str] | None = None,
-    available_systems: set[str] | None = None,
+    available_systems: list[str] | None = None,
     nix_diffs: dict[tuple[str, str], str | None] | None = None,
     markdown_ansi: bool = False,
 ) -> str:
@@ -204,15 +292,15 @@ def generate_markdown_report(
         changes: ChangeSet to report on
         results: Build results
         title: Report title
-        requested_systems: Systems that were requested for building
-        available_systems: All systems available in the flake
+        requested_systems: Systems that were requested for building, sorted
+        available_systems: All systems available in the flake, sorted
     """
     lines = [f"# {title}\n"]
 
     if available_systems:
-        lines.append(f"**Available systems:** {', '.join(sorted(available_systems))}")
+        lines.append(f"**Available systems:** {', '.join(available_systems)}")
     if requested_systems:
-        lines.append(f"**Requested systems:** {', '.join(sorted(requested_systems))}")
+        lines.append(f"**Requested systems:** {', '.join(requested_systems)}")
     if requested_systems or available_systems:
         lines.append("")
 
@@ -249,28 +337,28 @@ def merge_markdown_reports(
     sections: list[str] = []
 
     for path in report_files:
-        content = open(path).read().strip()  # noqa: SIM115
-        lines = content.split("\n")
-
-        # Strip title line, empty lines at start, and footer
+        # One streaming pass: strip the title, footer and any leading blank
+        # lines or stray ---, remembering where the last real line was so
+        # trailing ones can be cut with a single slice.
         filtered: list[str] = []
-        for line in lines:
-            if line.startswith("# "):
-                continue
-            if "Generated by [flake-review]" in line:
-                continue
-            if line.strip() == "---" and not filtered:
-                continue
-            filtered.append(line)
-
-        # Trim leading/trailing blank lines and stray ---
-        while filtered and (not filtered[0].strip() or filtered[0].strip() == "---"):
-            filtered.pop(0)
-        while filtered and (not filtered[-1].strip() or filtered[-1].strip() == "---"):
-            filtered.pop()
-
-        if filtered:
-            sections.append("\n".join(filtered))
+        end = 0
+        with open(path) as f:
+            for raw_line in f:
+                line = raw_line.rstrip("\n")
+                if line.startswith("# "):
+                    continue
+                if "Generated by [flake-review]" in line:
+                    continue
+                stripped = line.strip()
+                if not stripped or stripped == "---":
+                    if filtered:
+                        filtered.append(line)
+                    continue
+                filtered.append(line)
+                end = len(filtered)
+
+        if end:
+            sections.append("\n".join(filtered[:end]))
 
     merged = f"# {title}\n\n"
     merged += "\n\n---\n\n".join(sections)
@@ -307,15 +395,16 @@ def generate_json_report(
     changes: ChangeSet,
     results: BuildResults,
     requested_systems: list[str] | None = None,
-    available_systems: set[str] | None = None,
+    available_systems: list[str] | None = None,
     nix_diffs: dict[tuple[str, str], str | None] | None = None,
 ) -> dict[str, Any]:
     """Generate a structured JSON report.
 
     Captures nix-diff output eagerly so the merge step doesn't need
-    access to the derivations.
+    access to the derivations. The system lists are stored as given and
+    are expected to be sorted already.
     """
-    result_map = {r.derivation.attr_path: r for r in results.results}
+    result_map = results.by_attr_path
 
     added = []
     for drv in changes.added:
@@ -325,12 +414,12 @@ def generate_json_report(
 
     removed = [_drv_to_dict(drv) for drv in changes.removed]
 
+    if nix_diffs is None:
+        nix_diffs = collect_nix_diffs(changes)
+
     modified = []
     for old, new in changes.modified:
-        if nix_diffs is not None:
-            diff = nix_diffs.get(_diff_key(old.drv_path, new.drv_path))
-        else:
-            diff = _get_nix_diff(old.drv_path, new.drv_path)
+        diff = nix_diffs.get(_diff_key(old.drv_path, new.drv_path))
         entry = {
             "old": _drv_to_dict(old),
             "new": _drv_to_dict(new),
@@ -344,7 +433,7 @@ def generate_json_report(
         "version": 1,
         "metadata": {
             "requested_systems": requested_systems or [],
-            "available_systems": sorted(available_systems) if available_systems else [],
+            "available_systems": available_systems or [],
         },
         "changes": {
             "added": added,
@@ -356,9 +445,8 @@ def generate_json_report(
 
 def load_json_report(path: str) -> dict[str, Any]:
     """Read and validate a JSON report file."""
-    with open(path) as f:  # noqa: SIM115
-        data: dict[str, Any] = json.load(f)
-    if "version" not in data or "changes" not in data:
+    data = json_loads(Path(path).read_bytes())
+    if not isinstance(data, dict) or not {"version", "changes"}.issubset(data):
         msg = f"Invalid JSON report: {path}"
         raise ValueError(msg)
     return data
@@ -369,7 +457,11 @@ def _render_markdown_from_json(
     title: str = "Flake Review Results",
     markdown_ansi: bool = False,
 ) -> str:
-    """Render a markdown report from JSON report data."""
+    """Render a markdown report from JSON report data.
+
+    The metadata system lists are sorted by construction
+    (see merge_json_reports) and are joined as-is.
+    """
     lines = [f"# {title}\n"]
 
     meta = data.get("metadata", {})
@@ -377,9 +469,9 @@ def _render_markdown_from_json(
     requested = meta.get("requested_systems", [])
 
     if available:
-        lines.append(f"**Available systems:** {', '.join(sorted(available))}")
+        lines.append(f"**Available systems:** {', '.join(available)}")
     if requested:
-        lines.append(f"**Requested systems:** {', '.join(sorted(requested))}")
+        lines.append(f"**Requested systems:** {', '.join(requested)}")
     if available or requested:
         lines.append("")
 
@@ -498,19 +590,23 @@ def print_console_report(
     results: BuildResults,
     nix_diffs: dict[tuple[str, str], str | None] | None = None,
 ) -> None:
-    """Print a report to the console."""
-    print("\n" + "=" * 60)
-    print("FLAKE REVIEW RESULTS")
-    print("=" * 60 + "\n")
+    """Print a report to the console.
+
+    The report is assembled first and written with a single write, rather
+    than one print (and, on a terminal, one flush) per section.
+    """
+    rule = "=" * 60
+    parts = [f"\n{rule}\nFLAKE REVIEW RESULTS\n{rule}\n\n"]
 
     if changes.added or changes.modified or changes.removed:
-        print(
-            format_detailed_changes(
-                changes,
-                results,
-                markdown=False,
-                nix_diffs=nix_diffs,
-            )
+        details = format_detailed_changes(
+            changes,
+            results,
+            markdown=False,
+            nix_diffs=nix_diffs,
         )
+        parts.append(f"{details}\n")
 
-    print("=" * 60 + "\n")
+    parts.append(f"{rule}\n\n")
+    sys.stdout.write("".join(parts))
+    sys.stdout.flush()
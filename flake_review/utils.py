@@ -1,9 +1,26 @@
 """Utility functions for git operations and temporary directories."""
 
+import asyncio
+import functools
+import json
+import platform
 import shutil
 import subprocess
 import tempfile
+from collections import deque
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
 from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+# orjson is an optional speedup for large `nix eval --json` payloads
+# (pip install 'flake-review[fast]'); the stdlib parser is the fallback.
+_orjson: ModuleType | None
+try:
+    import orjson as _orjson  # type: ignore[no-redef]
+except ImportError:  # pragma: no cover - depends on the environment
+    _orjson = None
 
 
 class CommandError(Exception):
@@ -16,6 +33,35 @@ class CommandError(Exception):
         super().__init__(f"Command failed: {' '.join(cmd)}\n{stderr}")
 
 
+def json_loads(data: str | bytes) -> Any:
+    """Parse JSON, using orjson when it is installed."""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data: Any, *, indent: bool = False) -> str:
+    """Serialize JSON (2-space indented if requested), using orjson if installed."""
+    if _orjson is not None:
+        option = _orjson.OPT_INDENT_2 if indent else 0
+        dumped: bytes = _orjson.dumps(data, option=option)
+        return dumped.decode()
+    return json.dumps(data, indent=2 if indent else None)
+
+
+def tail_lines(lines: Iterable[str], count: int) -> list[str]:
+    """Get the last ``count`` non-blank lines, without their line endings.
+
+    Keeps at most ``count`` lines at a time, so a multi-MB log costs one
+    pass rather than a list of every line.
+    """
+    tail: deque[str] = deque(maxlen=count)
+    for line in lines:
+        if line.strip():
+            tail.append(line.rstrip("\r\n"))
+    return list(tail)
+
+
 def run_command(
     cmd: list[str],
     cwd: Path | None = None,
@@ -37,6 +83,26 @@ def run_command(
     return result
 
 
+def remove_tree_in_background(path: Path) -> None:
+    """Delete a directory tree without waiting for the deletion to finish.
+
+    A fresh clone has thousands of small files under .git, so removing it
+    inline delays exit after the report is already done. The detached
+    ``rm`` outlives this process. Falls back to a blocking delete if ``rm``
+    can't be spawned.
+    """
+    try:
+        subprocess.Popen(
+            ["rm", "-rf", str(path)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 def get_git_root(path: Path | None = None) -> Path:
     """Get the root of the git repository."""
     if path is None:
@@ -49,8 +115,58 @@ def get_git_root(path: Path | None = None) -> Path:
     return Path(result.stdout.strip())
 
 
+def get_git_rev(path: Path, ref: str = "HEAD") -> str:
+    """Resolve a git ref to its full commit SHA."""
+    result = run_command(["git", "rev-parse", ref], cwd=path)
+    return result.stdout.strip()
+
+
+def has_tree_changes(repo_path: Path, base: str, head: str | None = None) -> bool:
+    """Return True if any tracked file differs between two commits.
+
+    With head=None, base is compared against the working tree. Evaluation
+    can read any tracked file (``src = ./.``), so an unchanged tree is the
+    only case where outputs are known not to change. Errors count as changes.
+    """
+    cmd = ["git", "diff", "--quiet", base]
+    if head is not None:
+        cmd.append(head)
+    return run_command(cmd, cwd=repo_path, check=False).returncode != 0
+
+
+def get_changed_files(repo_path: Path, base: str, head: str | None = None) -> list[str]:
+    """List tracked files that differ between two commits, relative to the root.
+
+    With head=None, base is compared against the working tree.
+    """
+    cmd = ["git", "diff", "--name-only", "--no-renames", base]
+    if head is not None:
+        cmd.append(head)
+    return run_command(cmd, cwd=repo_path).stdout.splitlines()
+
+
+_NIX_MACHINES = {
+    "x86_64": "x86_64",
+    "AMD64": "x86_64",
+    "amd64": "x86_64",
+    "arm64": "aarch64",
+    "aarch64": "aarch64",
+}
+_NIX_KERNELS = {"Linux": "linux", "Darwin": "darwin"}
+
+
+@functools.cache
 def get_current_system() -> str:
-    """Get the current Nix system string (e.g., x86_64-linux, aarch64-darwin)."""
+    """Get the current Nix system string (e.g., x86_64-linux, aarch64-darwin).
+
+    Derived from ``platform`` on the common hosts, so no nix evaluator has
+    to start; anything else asks Nix. Cached for the process either way.
+    """
+    machine = _NIX_MACHINES.get(platform.machine())
+    kernel = _NIX_KERNELS.get(platform.system())
+    if machine and kernel:
+        return f"{machine}-{kernel}"
+
     result = run_command(
         ["nix", "eval", "--impure", "--raw", "--expr", "builtins.currentSystem"]
     )
@@ -90,3 +206,120 @@ class GitWorktree:
             # Clean up temp directory if it still exists
             if self.worktree_path.exists():
                 shutil.rmtree(self.worktree_path)
+
+
+async def run_command_async(
+    cmd: list[str],
+    cwd: Path | None = None,
+    check: bool = True,
+) -> tuple[int, str, str]:
+    """Run a command without blocking the event loop.
+
+    Returns ``(returncode, stdout, stderr)``.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    returncode = proc.returncode or 0
+
+    if check and returncode != 0:
+        raise CommandError(cmd, returncode, stderr.decode())
+
+    return returncode, stdout.decode(), stderr.decode()
+
+
+class AsyncGitWorktree:
+    """Async GitWorktree, so several checkouts can be created at once.
+
+    ``git worktree add``/``remove`` read every other worktree's metadata and
+    fail if another one is being registered at the same time, so those run
+    under a shared lock; only the checkout itself runs concurrently.
+    """
+
+    def __init__(self, repo_path: Path, ref: str):
+        self.repo_path = repo_path
+        self.ref = ref
+        self.worktree_path: Path | None = None
+
+    async def create(self, lock: asyncio.Lock) -> Path:
+        """Create a temporary worktree, registering it while holding ``lock``."""
+        path = Path(tempfile.mkdtemp(prefix="flake-review-"))
+        try:
+            async with lock:
+                await run_command_async(
+                    [
+                        "git",
+                        "worktree",
+                        "add",
+                        "--detach",
+                        "--no-checkout",
+                        str(path),
+                        self.ref,
+                    ],
+                    cwd=self.repo_path,
+                )
+            self.worktree_path = path
+            await run_command_async(["git", "reset", "--hard", "--quiet"], cwd=path)
+        except BaseException:
+            await self.remove(lock)
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        return path
+
+    async def remove(self, lock: asyncio.Lock) -> None:
+        """Remove the temporary worktree, holding ``lock`` while unregistering."""
+        if self.worktree_path is not None:
+            async with lock:
+                await run_command_async(
+                    ["git", "worktree", "remove", "--force", str(self.worktree_path)],
+                    cwd=self.repo_path,
+                    check=False,  # Don't fail if already removed
+                )
+
+            # Clean up temp directory if it still exists
+            if self.worktree_path.exists():
+                shutil.rmtree(self.worktree_path)
+            self.worktree_path = None
+
+    async def __aenter__(self) -> Path:
+        """Create a temporary worktree."""
+        return await self.create(asyncio.Lock())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:  # type: ignore
+        """Remove the temporary worktree."""
+        await self.remove(asyncio.Lock())
+
+
+@contextmanager
+def git_worktrees(repo_path: Path, *refs: str) -> Iterator[list[Path]]:
+    """Check out several refs as temporary worktrees, created concurrently.
+
+    If any checkout fails, the ones that succeeded are removed before the
+    error is raised.
+    """
+    worktrees = [AsyncGitWorktree(repo_path, ref) for ref in refs]
+
+    async def remove_all(lock: asyncio.Lock | None = None) -> None:
+        lock = lock or asyncio.Lock()
+        await asyncio.gather(*(w.remove(lock) for w in worktrees))
+
+    async def add_all() -> list[Path]:
+        lock = asyncio.Lock()
+        added = await asyncio.gather(
+            *(w.create(lock) for w in worktrees), return_exceptions=True
+        )
+        paths = [p for p in added if isinstance(p, Path)]
+        if len(paths) != len(added):
+            await remove_all(lock)
+            raise next(e for e in added if isinstance(e, BaseException))
+        return paths
+
+    paths = asyncio.run(add_all())
+    try:
+        yield paths
+    finally:
+        asyncio.run(remove_all())
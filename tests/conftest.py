@@ -0,0 +1,81 @@
+"""Shared fixtures for the test suite."""
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from flake_review.build import BuildResults
+from flake_review.flake import DerivationInfo
+from flake_review.github import PullRequest
+
+
+@pytest.fixture
+def pkg_drv() -> DerivationInfo:
+    """A single x86_64-linux package derivation."""
+    return DerivationInfo(
+        attr_path="packages.x86_64-linux.pkg",
+        drv_path="/nix/store/pkg.drv",
+        output_type="packages",
+        system="x86_64-linux",
+        name="pkg",
+    )
+
+
+@pytest.fixture
+def old_new_drv_pair() -> tuple[DerivationInfo, DerivationInfo]:
+    """The base and head derivations of a modified package."""
+    old = DerivationInfo(
+        attr_path="packages.x86_64-linux.pkg",
+        drv_path="/nix/store/old.drv",
+        output_type="packages",
+        system="x86_64-linux",
+        name="pkg",
+    )
+    new = DerivationInfo(
+        attr_path="packages.x86_64-linux.pkg",
+        drv_path="/nix/store/new.drv",
+        output_type="packages",
+        system="x86_64-linux",
+        name="pkg",
+    )
+    return old, new
+
+
+@pytest.fixture
+def empty_build_results() -> BuildResults:
+    """Build results for a run that built nothing."""
+    return BuildResults(results=[])
+
+
+@pytest.fixture
+def mock_run_command(monkeypatch: pytest.MonkeyPatch) -> MagicMock:
+    """Replace the run_command used for nix evaluation in flake.py."""
+    mock = MagicMock()
+    monkeypatch.setattr("flake_review.flake.run_command", mock)
+    return mock
+
+
+@pytest.fixture
+def pr_pair() -> tuple[PullRequest, PullRequest]:
+    """A fork PR and a same-repo PR against upstream/repo."""
+    fork = PullRequest(
+        owner="upstream",
+        repo="repo",
+        number=1,
+        base_ref="main",
+        base_sha="abc123",
+        head_ref="feature",
+        head_sha="def456",
+        head_repo_url="https://github.com/fork/repo.git",
+    )
+    same_repo = PullRequest(
+        owner="upstream",
+        repo="repo",
+        number=2,
+        base_ref="main",
+        base_sha="abc123",
+        head_ref="feature",
+        head_sha="ghi789",
+        head_repo_url=None,
+    )
+    return fork, same_repo
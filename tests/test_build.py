@@ -1,7 +1,21 @@
 """Tests for build functionality."""
 
-from flake_review.build import BuildResult, BuildResults
-from flake_review.flake import DerivationInfo
+import asyncio
+import json
+from dataclasses import replace
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from flake_review.build import (
+    BuildResult,
+    BuildResults,
+    build_changes,
+    build_changes_async,
+    build_derivation,
+    find_realised_outputs,
+)
+from flake_review.flake import ChangeSet, DerivationInfo
 
 
 def test_build_result_success() -> None:
@@ -87,3 +101,238 @@ def test_build_results_mixed() -> None:
     assert len(results.failed) == 1
     assert results.successful[0] == result1
     assert results.failed[0] == result2
+
+
+def test_build_results_by_attr_path_is_cached() -> None:
+    """The attr-path lookup is built once and shared between readers."""
+    result = BuildResult(derivation=_drv("pkg"), success=True)
+    results = BuildResults(results=[result])
+
+    assert results.by_attr_path == {"packages.x86_64-linux.pkg": result}
+    assert results.by_attr_path is results.by_attr_path
+
+
+class _FakeStream:
+    """Minimal asyncio.StreamReader stand-in."""
+
+    def __init__(self, data: bytes) -> None:
+        self._lines = data.splitlines(keepends=True)
+        self._data = data
+
+    def __aiter__(self) -> "_FakeStream":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if not self._lines:
+            raise StopAsyncIteration
+        return self._lines.pop(0)
+
+    async def read(self) -> bytes:
+        return self._data
+
+
+class _FakeProcess:
+    """Minimal asyncio.subprocess.Process stand-in."""
+
+    def __init__(self, stdout: bytes = b"", stderr: bytes = b"", rc: int = 0) -> None:
+        self.stdout = _FakeStream(stdout)
+        self.stderr = _FakeStream(stderr)
+        self.returncode = rc
+        self.terminated = False
+
+    async def communicate(self) -> tuple[bytes, bytes]:
+        return await self.stdout.read(), await self.stderr.read()
+
+    async def wait(self) -> int:
+        return self.returncode
+
+    def terminate(self) -> None:
+        self.terminated = True
+
+
+def _drv(name: str) -> DerivationInfo:
+    return DerivationInfo(
+        attr_path=f"packages.x86_64-linux.{name}",
+        drv_path=f"/nix/store/{name}.drv",
+        output_type="packages",
+        system="x86_64-linux",
+        name=name,
+    )
+
+
+def test_build_derivation_keeps_only_log_tail(monkeypatch) -> None:  # type: ignore
+    """Failed builds keep the last log lines; successful builds keep none."""
+    log = "".join(f"line {i}\n" for i in range(1000)).encode()
+
+    async def fake_exec(*cmd: str, **kwargs):  # type: ignore
+        return _FakeProcess(stderr=log, rc=1 if "broken" in cmd[2] else 0)
+
+    monkeypatch.setattr("flake_review.build.asyncio.create_subprocess_exec", fake_exec)
+
+    failed = asyncio.run(build_derivation(Path("/fake"), _drv("broken")))
+    assert failed.build_log is not None
+    lines = failed.build_log.splitlines()
+    assert len(lines) == 200
+    assert lines[0] == "line 800"
+    assert lines[-1] == "line 999"
+    assert failed.error == failed.build_log
+
+    ok = asyncio.run(build_derivation(Path("/fake"), _drv("ok")))
+    assert ok.success is True
+    assert ok.build_log is None
+
+
+def test_build_derivation_builds_known_drv_path(monkeypatch) -> None:  # type: ignore
+    """A derivation with a drvPath is built from it, not re-evaluated."""
+    calls: list[tuple[str, ...]] = []
+
+    async def fake_exec(*cmd: str, **kwargs):  # type: ignore
+        calls.append(cmd)
+        return _FakeProcess(stdout=b"/nix/store/pkg-out\n")
+
+    monkeypatch.setattr("flake_review.build.asyncio.create_subprocess_exec", fake_exec)
+
+    result = asyncio.run(build_derivation(Path("/fake"), _drv("pkg")))
+    unknown = replace(_drv("pkg"), drv_path="")
+    asyncio.run(build_derivation(Path("/fake"), unknown))
+
+    assert result.output_path == "/nix/store/pkg-out"
+    assert [cmd[2] for cmd in calls] == [
+        "/nix/store/pkg.drv^*",
+        "/fake#packages.x86_64-linux.pkg",
+    ]
+
+
+def test_build_changes_async_respects_max_workers(monkeypatch) -> None:  # type: ignore
+    """No more than max_workers builds run at the same time."""
+    running = 0
+    peak = 0
+
+    async def fake_build(flake_path: Path, drv: DerivationInfo) -> BuildResult:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0)
+        running -= 1
+        return BuildResult(derivation=drv, success=True)
+
+    monkeypatch.setattr("flake_review.build.build_derivation", fake_build)
+
+    to_build = [_drv(f"pkg{i}") for i in range(6)]
+    results = asyncio.run(build_changes_async(Path("/fake"), to_build, max_workers=2))
+
+    assert results.success_count == 6
+    assert peak == 2
+
+
+def test_build_changes_async_fail_fast_cancels_pending(monkeypatch) -> None:  # type: ignore
+    """With fail_fast, builds still waiting are cancelled after a failure."""
+
+    async def fake_build(flake_path: Path, drv: DerivationInfo) -> BuildResult:
+        if drv.name == "broken":
+            return BuildResult(derivation=drv, success=False, error="boom")
+        await asyncio.sleep(1)
+        return BuildResult(derivation=drv, success=True)
+
+    monkeypatch.setattr("flake_review.build.build_derivation", fake_build)
+
+    to_build = [_drv("broken"), _drv("slow"), _drv("queued")]
+    results = asyncio.run(
+        build_changes_async(Path("/fake"), to_build, max_workers=2, fail_fast=True)
+    )
+
+    assert [r.derivation.name for r in results.results] == ["broken"]
+
+
+def test_build_changes_defaults_max_workers_to_cpu_count(monkeypatch) -> None:  # type: ignore
+    """Without --max-workers, one build worker runs per usable CPU."""
+    drv = _drv("pkg")
+    changes = ChangeSet(added=[drv], removed=[], modified=[])
+    monkeypatch.setattr(
+        "flake_review.build.os.sched_getaffinity", lambda pid: {0, 1, 2}, raising=False
+    )
+
+    with (
+        patch("flake_review.build.find_realised_outputs", return_value={}),
+        patch(
+            "flake_review.build.build_changes_async",
+            return_value=BuildResults(results=[]),
+        ) as mock_build,
+    ):
+        build_changes(Path("/fake"), changes)
+
+    assert mock_build.call_args.args[2] == 3
+
+
+def test_build_changes_skips_realised_outputs() -> None:
+    """Derivations whose outputs are already valid are not rebuilt."""
+    built, cached = _drv("built"), _drv("cached")
+    changes = ChangeSet(added=[built, cached], removed=[], modified=[])
+
+    with (
+        patch(
+            "flake_review.build.find_realised_outputs",
+            return_value={cached.drv_path: ["/nix/store/cached-out"]},
+        ),
+        patch(
+            "flake_review.build.build_derivation",
+            return_value=BuildResult(derivation=built, success=True),
+        ) as mock_build,
+    ):
+        results = build_changes(Path("/fake"), changes)
+
+    mock_build.assert_called_once_with(Path("/fake"), built)
+    by_name = {r.derivation.name: r for r in results.results}
+    assert by_name["cached"].success is True
+    assert by_name["cached"].output_path == "/nix/store/cached-out"
+
+
+def test_build_changes_builds_shared_drv_paths_once() -> None:
+    """Attributes with the same drvPath are built once and share the result."""
+    pkg = _drv("pkg")
+    alias = DerivationInfo(
+        attr_path="packages.x86_64-linux.default",
+        drv_path=pkg.drv_path,
+        output_type="packages",
+        system="x86_64-linux",
+        name="default",
+    )
+    changes = ChangeSet(added=[pkg, alias], removed=[], modified=[])
+
+    with (
+        patch("flake_review.build.find_realised_outputs", return_value={}),
+        patch(
+            "flake_review.build.build_derivation",
+            return_value=BuildResult(
+                derivation=pkg, success=True, output_path="/nix/store/pkg-out"
+            ),
+        ) as mock_build,
+    ):
+        results = build_changes(Path("/fake"), changes)
+
+    mock_build.assert_called_once_with(Path("/fake"), pkg)
+    assert [r.derivation for r in results.results] == [pkg, alias]
+    assert {r.output_path for r in results.results} == {"/nix/store/pkg-out"}
+
+
+def test_find_realised_outputs_excludes_invalid_paths() -> None:
+    """Only derivations with every output valid are reported."""
+    shown = {
+        "/nix/store/a.drv": {"outputs": {"out": {"path": "/nix/store/a-out"}}},
+        "/nix/store/b.drv": {
+            "outputs": {
+                "out": {"path": "/nix/store/b-out"},
+                "dev": {"path": "/nix/store/b-dev"},
+            }
+        },
+    }
+
+    def fake_run(cmd: list[str], **kwargs):  # type: ignore
+        if cmd[:3] == ["nix", "derivation", "show"]:
+            return SimpleNamespace(stdout=json.dumps(shown), returncode=0)
+        return SimpleNamespace(stdout="/nix/store/b-dev\n", returncode=0)
+
+    with patch("flake_review.build.run_command", side_effect=fake_run):
+        realised = find_realised_outputs([_drv("a"), _drv("b")])
+
+    assert realised == {"/nix/store/a.drv": ["/nix/store/a-out"]}
@@ -0,0 +1,24 @@
+"""Tests for on-disk caches."""
+
+from flake_review.cache import get_cache_dir, load_json_cache, save_json_cache
+
+
+def test_get_cache_dir_honours_xdg(monkeypatch, tmp_path) -> None:  # type: ignore
+    """The cache lives under $XDG_CACHE_HOME when set."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert get_cache_dir() == tmp_path / "flake-review"
+
+
+def test_json_cache_roundtrip(tmp_path) -> None:  # type: ignore
+    """Saved data is read back unchanged."""
+    path = tmp_path / "nested" / "cache.json"
+    save_json_cache(path, {"packages.x86_64-linux.pkg": "/nix/store/pkg.drv"})
+    assert load_json_cache(path) == {"packages.x86_64-linux.pkg": "/nix/store/pkg.drv"}
+
+
+def test_load_json_cache_missing_or_corrupt(tmp_path) -> None:  # type: ignore
+    """Missing and corrupt cache files are treated as empty."""
+    assert load_json_cache(tmp_path / "missing.json") is None
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text("{not json")
+    assert load_json_cache(corrupt) is None
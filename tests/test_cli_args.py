@@ -1,5 +1,9 @@
 """Tests for CLI argument parsing."""
 
+from unittest.mock import MagicMock
+
+import pytest
+
 from flake_review.cli import main
 
 
@@ -44,3 +48,25 @@ def test_merge_reports_post_result_requires_pr_url(monkeypatch, capsys):  # type
 
     captured = capsys.readouterr()
     assert "--pr-url is required" in captured.err
+
+
+def test_pr_command_defers_marker_comment_lookup(monkeypatch, tmp_path):  # type: ignore
+    """Test pr fetches only the PR up front; the comment is found at post time."""
+    client = MagicMock()
+    client.get_pull_request.return_value.is_fork = False
+    run_command = MagicMock()
+    monkeypatch.setattr("flake_review.cli.GithubClient", lambda: client)
+    monkeypatch.setattr("flake_review.cli.tempfile.mkdtemp", lambda prefix: tmp_path)
+    monkeypatch.setattr("flake_review.cli.run_command", run_command)
+    # Stops the review right after the fetch, before any nix evaluation
+    monkeypatch.setattr("flake_review.cli.has_tree_changes", lambda *args: False)
+    monkeypatch.setattr("flake_review.cli.remove_tree_in_background", MagicMock())
+    monkeypatch.setattr("sys.argv", ["flake-review", "pr", "owner/repo#1"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        main()
+
+    assert excinfo.value.code == 0
+    assert run_command.call_count == 3  # git init, remote add, fetch
+    client.get_pull_request.assert_called_once_with("owner", "repo", 1)
+    client.get_pr_and_marker_comment.assert_not_called()
@@ -1,6 +1,35 @@
 """Tests for flake output comparison."""
 
-from flake_review.flake import ChangeSet, DerivationInfo
+import json
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from flake_review.flake import (
+    ChangeSet,
+    DerivationInfo,
+    FlakeOutputs,
+    _nix_string,
+    compare_outputs,
+    packages_owning_files,
+)
+
+
+@pytest.mark.parametrize(
+    ("text", "literal"),
+    [
+        ("pkg", '"pkg"'),
+        ('say "hi"', '"say \\"hi\\""'),
+        ("a\\u00e9", '"a\\\\u00e9"'),
+        ("${builtins.abort 1}", '"\\${builtins.abort 1}"'),
+        ("$x", '"$x"'),
+    ],
+)
+def test_nix_string_escapes_for_nix(text, literal) -> None:  # type: ignore
+    """Quotes, backslashes and interpolations come through as plain text."""
+    assert _nix_string(text) == literal
 
 
 def test_derivation_info_creation() -> None:
@@ -72,3 +101,168 @@ def test_changeset_with_changes() -> None:
     assert changes.removed[0].name == "old"
     assert changes.modified[0][0].drv_path == "/nix/store/old-modified.drv"
     assert changes.modified[0][1].drv_path == "/nix/store/new-modified.drv"
+
+
+def test_derivation_path_cached_per_rev(tmp_path, monkeypatch) -> None:  # type: ignore
+    """Immutable flakes read drv paths back from the on-disk cache."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    flake_dir = tmp_path / "flake"
+    flake_dir.mkdir()
+    (flake_dir / "flake.lock").write_text("{}")
+
+    with (
+        patch("flake_review.flake.get_git_rev", return_value="abc123"),
+        patch("flake_review.flake.run_command") as mock_run,
+    ):
+        mock_run.return_value = SimpleNamespace(
+            stdout="/nix/store/pkg.drv", returncode=0
+        )
+        first = FlakeOutputs(flake_dir, immutable=True)
+        assert first._get_derivation_path("packages.x86_64-linux.pkg") == (
+            "/nix/store/pkg.drv"
+        )
+        assert mock_run.call_count == 1
+
+        second = FlakeOutputs(flake_dir, immutable=True)
+        assert second._get_derivation_path("packages.x86_64-linux.pkg") == (
+            "/nix/store/pkg.drv"
+        )
+        assert mock_run.call_count == 1
+
+
+def test_derivation_path_not_cached_for_mutable_flake(tmp_path, monkeypatch) -> None:  # type: ignore
+    """The working tree (local mode) always re-evaluates."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    with patch("flake_review.flake.run_command") as mock_run:
+        mock_run.return_value = SimpleNamespace(
+            stdout="/nix/store/pkg.drv", returncode=0
+        )
+        outputs = FlakeOutputs(tmp_path)
+        outputs._get_derivation_path("packages.x86_64-linux.pkg")
+        outputs._get_derivation_path("packages.x86_64-linux.pkg")
+
+    assert mock_run.call_count == 2
+    assert not (tmp_path / "cache").exists()
+
+
+def test_compare_outputs_evaluates_sides_concurrently() -> None:
+    """Base and target derivations are evaluated at the same time."""
+    barrier = threading.Barrier(2, timeout=5)
+
+    class _Side:
+        def get_derivations(self, *args):  # type: ignore
+            barrier.wait()  # Raises BrokenBarrierError if run sequentially
+            return []
+
+    changes = compare_outputs(_Side(), _Side())  # type: ignore[arg-type]
+    assert changes == ChangeSet(added=[], removed=[], modified=[])
+
+
+def test_raw_outputs_cached_per_rev(tmp_path, monkeypatch) -> None:  # type: ignore
+    """Immutable flakes read attribute names back from the on-disk cache."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    flake_dir = tmp_path / "flake"
+    flake_dir.mkdir()
+    (flake_dir / "flake.lock").write_text("{}")
+
+    with (
+        patch("flake_review.flake.get_git_rev", return_value="abc123"),
+        patch("flake_review.flake.run_command") as mock_run,
+    ):
+        mock_run.return_value = SimpleNamespace(
+            stdout='{"x86_64-linux": ["pkg"]}', returncode=0
+        )
+        first = FlakeOutputs(flake_dir, immutable=True)._get_raw_outputs()
+        second = FlakeOutputs(flake_dir, immutable=True)._get_raw_outputs()
+
+    assert mock_run.call_count == 1
+    assert (
+        first
+        == second
+        == {"packages": {"x86_64-linux": {"pkg": {"type": "derivation"}}}}
+    )
+    assert (tmp_path / "cache/flake-review/outputs/abc123-packages.json").exists()
+
+
+def test_compare_outputs_classifies_changes() -> None:
+    """Added, removed and modified attributes are found and sorted."""
+
+    def drv(name: str, drv_path: str) -> DerivationInfo:
+        return DerivationInfo(
+            attr_path=f"packages.x86_64-linux.{name}",
+            drv_path=drv_path,
+            output_type="packages",
+            system="x86_64-linux",
+            name=name,
+        )
+
+    class _Side:
+        def __init__(self, derivations: list[DerivationInfo]) -> None:
+            self.derivations = derivations
+
+        def get_derivations(self, *args):  # type: ignore
+            return self.derivations
+
+    base = _Side([drv("same", "/s.drv"), drv("old", "/o.drv"), drv("mod", "/m1.drv")])
+    head = _Side(
+        [
+            drv("zeta", "/z.drv"),
+            drv("mod", "/m2.drv"),
+            drv("same", "/s.drv"),
+            drv("alpha", "/a.drv"),
+        ]
+    )
+
+    changes = compare_outputs(base, head)  # type: ignore[arg-type]
+
+    assert [d.name for d in changes.added] == ["alpha", "zeta"]
+    assert [d.name for d in changes.removed] == ["old"]
+    assert [(o.drv_path, n.drv_path) for o, n in changes.modified] == [
+        ("/m1.drv", "/m2.drv")
+    ]
+
+
+def test_eval_cache_only_bypassed_for_mutable_flakes(tmp_path) -> None:  # type: ignore
+    """--no-eval-cache is passed for the working tree, not for fixed commits."""
+    with patch("flake_review.flake.run_command") as mock_run:
+        mock_run.return_value = SimpleNamespace(stdout="{}", returncode=0)
+        FlakeOutputs(tmp_path)._get_raw_outputs()
+        FlakeOutputs(tmp_path, immutable=True)._get_raw_outputs()
+
+    mutable_cmd, immutable_cmd = (call.args[0] for call in mock_run.call_args_list)
+    assert "--no-eval-cache" in mutable_cmd
+    assert "--no-eval-cache" not in immutable_cmd
+
+
+def test_get_source_positions_strips_store_prefix(tmp_path) -> None:  # type: ignore
+    """Positions become flake-relative files; outside positions are dropped."""
+    raw = {
+        "x86_64-linux": {
+            "foo": "/nix/store/abc-source/pkgs/foo/default.nix:12",
+            "hello": "/nix/store/def-nixpkgs/pkgs/hello/default.nix:3",
+            "bare": None,
+        }
+    }
+    with patch("flake_review.flake.run_command") as mock_run:
+        mock_run.return_value = SimpleNamespace(stdout=json.dumps(raw), returncode=0)
+        positions = FlakeOutputs(tmp_path).get_source_positions(
+            "packages", ["x86_64-linux"]
+        )
+
+    assert positions == {"foo": "pkgs/foo/default.nix"}
+
+
+@pytest.mark.parametrize(
+    ("changed", "expected"),
+    [
+        (["pkgs/foo/fix.patch"], ["foo"]),
+        (["pkgs/foo/default.nix", "pkgs/bar/src.c"], ["bar", "foo"]),
+        (["README.md"], None),
+        (["pkgs/foo/default.nix", "flake.lock"], None),
+    ],
+)
+def test_packages_owning_files(changed, expected) -> None:  # type: ignore
+    """Changed files select packages, or disable the filter if unscoped."""
+    positions = {"foo": "pkgs/foo/default.nix", "bar": "pkgs/bar/default.nix"}
+    assert packages_owning_files(positions, changed) == expected
@@ -2,23 +2,27 @@
 
 import json
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from types import SimpleNamespace
+from unittest.mock import patch
 
 from flake_review.flake import ChangeSet, DerivationInfo, FlakeOutputs
-from flake_review.github import PullRequest
 
+# Mock `nix eval --apply builtins.attrNames` output, serialized once for the module
+_MOCK_ATTR_NAMES_JSON = json.dumps({"x86_64-linux": ["default"]})
 
-def test_flake_outputs_handles_missing_systems() -> None:
-    """Test that FlakeOutputs handles systems that don't exist gracefully."""
-    # Mock flake show output
-    mock_output = {"packages": {"x86_64-linux": {"default": {"type": "derivation"}}}}
 
-    with patch("flake_review.flake.run_command") as mock_run:
-        mock_run.return_value = MagicMock(
-            stdout=json.dumps(mock_output),
-            returncode=0,
-        )
+def _mock_nix_eval(cmd: list[str], **kwargs: object) -> SimpleNamespace:
+    """Answer the attr-names listing and per-attribute drvPath evals."""
+    if "--apply" in cmd:
+        stdout = _MOCK_ATTR_NAMES_JSON
+    else:
+        stdout = "/nix/store/default.drv"
+    return SimpleNamespace(stdout=stdout, returncode=0, stderr="")
 
+
+def test_flake_outputs_handles_missing_systems() -> None:
+    """Test that FlakeOutputs handles systems that don't exist gracefully."""
+    with patch("flake_review.flake.run_command", side_effect=_mock_nix_eval):
         outputs = FlakeOutputs(Path("/fake/path"))
 
         # Request systems that don't exist
@@ -27,10 +31,9 @@ def test_flake_outputs_handles_missing_systems() -> None:
             systems=["x86_64-linux", "aarch64-darwin", "nonexistent"],
         )
 
-        # Should only return derivations for x86_64-linux
-        assert len([d for d in derivations if d.system == "x86_64-linux"]) >= 0
-        assert len([d for d in derivations if d.system == "aarch64-darwin"]) == 0
-        assert len([d for d in derivations if d.system == "nonexistent"]) == 0
+    # Should only return derivations for x86_64-linux
+    assert [d.attr_path for d in derivations] == ["packages.x86_64-linux.default"]
+    assert derivations[0].drv_path == "/nix/store/default.drv"
 
 
 def test_changeset_detects_added_packages() -> None:
@@ -93,29 +96,9 @@ def test_changeset_detects_modified_packages() -> None:
     assert changes.modified[0][1].drv_path == "/nix/store/new.drv"
 
 
-def test_pull_request_fork_detection() -> None:
+def test_pull_request_fork_detection(pr_pair) -> None:  # type: ignore
     """Test that fork PRs are correctly detected."""
-    fork_pr = PullRequest(
-        owner="upstream",
-        repo="repo",
-        number=1,
-        base_ref="main",
-        base_sha="abc123",
-        head_ref="feature",
-        head_sha="def456",
-        head_repo_url="https://github.com/fork/repo.git",
-    )
-
-    same_repo_pr = PullRequest(
-        owner="upstream",
-        repo="repo",
-        number=2,
-        base_ref="main",
-        base_sha="abc123",
-        head_ref="feature",
-        head_sha="ghi789",
-        head_repo_url=None,
-    )
+    fork_pr, same_repo_pr = pr_pair
 
     assert fork_pr.is_fork is True
     assert same_repo_pr.is_fork is False
@@ -4,7 +4,13 @@ import json
 import tempfile
 from pathlib import Path
 
-from flake_review.report import merge_json_reports, merge_markdown_reports
+import pytest
+
+from flake_review.report import (
+    load_json_report,
+    merge_json_reports,
+    merge_markdown_reports,
+)
 
 DARWIN_REPORT = """\
 # Flake Review Results for [#137](https://github.com/example/repo/pull/137)
@@ -86,6 +92,29 @@ def test_merge_single_report() -> None:
     Path(path).unlink()
 
 
+def test_merge_trims_blank_lines_and_separators() -> None:
+    """Test exact section boundaries after title, footer and --- are removed."""
+    path = _write_temp(LINUX_REPORT)
+
+    merged = merge_markdown_reports([path, path], title="Test")
+
+    section = (
+        "**Available systems:** x86_64-linux\n"
+        "**Requested systems:** x86_64-linux\n"
+        "\n"
+        "### 🔄 Modified (1)\n"
+        "\n"
+        "- ✅ `packages.x86_64-linux.injection`\n"
+        "  - Output: `/nix/store/ghi-TidaLuna`"
+    )
+    assert merged == (
+        f"# Test\n\n{section}\n\n---\n\n{section}\n\n---\n"
+        "*Generated by [flake-review](https://github.com/ojsef39/flake-review)*"
+    )
+
+    Path(path).unlink()
+
+
 def test_merge_preserves_system_info() -> None:
     """Test that system info from individual reports is preserved."""
     darwin_path = _write_temp(DARWIN_REPORT)
@@ -233,3 +262,26 @@ def test_merge_json_single_report() -> None:
     assert merged.count("Generated by [flake-review]") == 1
 
     Path(path).unlink()
+
+
+@pytest.mark.parametrize(
+    "content", ['{"version": 1}', "[1, 2]", "# Markdown report", ""]
+)
+def test_load_json_report_rejects_non_reports(content) -> None:  # type: ignore
+    """Test files that aren't JSON reports raise ValueError."""
+    path = _write_temp(content)
+
+    with pytest.raises(ValueError):
+        load_json_report(path)
+
+    Path(path).unlink()
+
+
+def test_load_json_report_reads_report() -> None:
+    """Test a JSON report is read back as written."""
+    report = {"version": 1, "metadata": {}, "changes": {"added": []}}
+    path = _write_temp(json.dumps(report))
+
+    assert load_json_report(path) == report
+
+    Path(path).unlink()
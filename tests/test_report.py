@@ -1,92 +1,140 @@
 """Tests for report generation."""
 
+import io
+import os
+import threading
+from dataclasses import replace
 from unittest.mock import patch
 
+import pytest
+
 from flake_review.build import BuildResult, BuildResults
 from flake_review.flake import ChangeSet, DerivationInfo
 from flake_review.report import (
+    _format_build_error,
+    _format_diff_section,
+    _get_nix_diff,
+    _nix_diff_env,
+    _nix_diffs,
     _render_markdown_from_json,
     _strip_ansi,
+    collect_nix_diffs,
     format_detailed_changes,
     generate_json_report,
     generate_markdown_report,
+    print_console_report,
 )
 
+# JSON report data shared by the _render_markdown_from_json tests. The
+# renderer only reads its input, so the tests pass these without copying.
+_RENDER_FIXTURE = {
+    "version": 1,
+    "metadata": {
+        "requested_systems": ["x86_64-linux", "aarch64-darwin"],
+        "available_systems": ["x86_64-linux", "aarch64-darwin"],
+    },
+    "changes": {
+        "added": [
+            {
+                "attr_path": "packages.x86_64-linux.new",
+                "drv_path": "/nix/store/new.drv",
+                "output_type": "packages",
+                "system": "x86_64-linux",
+                "name": "new",
+                "build": {
+                    "success": True,
+                    "output_path": "/nix/store/new-out",
+                    "error": None,
+                },
+            }
+        ],
+        "removed": [],
+        "modified": [
+            {
+                "old": {
+                    "attr_path": "packages.aarch64-darwin.pkg",
+                    "drv_path": "/nix/store/old.drv",
+                    "output_type": "packages",
+                    "system": "aarch64-darwin",
+                    "name": "pkg",
+                },
+                "new": {
+                    "attr_path": "packages.aarch64-darwin.pkg",
+                    "drv_path": "/nix/store/new.drv",
+                    "output_type": "packages",
+                    "system": "aarch64-darwin",
+                    "name": "pkg",
+                },
+                "nix_diff": "- old input\n+ new input",
+                "build": {
+                    "success": True,
+                    "output_path": "/nix/store/pkg-out",
+                    "error": None,
+                },
+            }
+        ],
+    },
+}
+
+_ANSI_DIFF_FIXTURE = {
+    "version": 1,
+    "metadata": {"requested_systems": [], "available_systems": []},
+    "changes": {
+        "added": [],
+        "removed": [],
+        "modified": [
+            {
+                "old": {
+                    "attr_path": "packages.x86_64-linux.pkg",
+                    "drv_path": "/nix/store/old.drv",
+                    "output_type": "packages",
+                    "system": "x86_64-linux",
+                    "name": "pkg",
+                },
+                "new": {
+                    "attr_path": "packages.x86_64-linux.pkg",
+                    "drv_path": "/nix/store/new.drv",
+                    "output_type": "packages",
+                    "system": "x86_64-linux",
+                    "name": "pkg",
+                },
+                "nix_diff": "- old\n+ new",
+                "nix_diff_ansi": "\u001b[31m- old\u001b[0m\n\u001b[32m+ new\u001b[0m",
+                "build": None,
+            }
+        ],
+    },
+}
+
+
+@pytest.mark.parametrize(
+    ("kind", "header"),
+    [
+        ("added", "Added (1)"),
+        ("removed", "Removed (1)"),
+        ("modified", "Modified (1)"),
+    ],
+)
+def test_format_detailed_changes_kind(  # type: ignore
+    kind, header, pkg_drv, old_new_drv_pair, empty_build_results
+) -> None:
+    """Test detailed changes for added, removed and modified packages.
 
-def test_format_detailed_changes_added() -> None:
-    """Test detailed changes for added packages."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.new",
-        drv_path="/nix/store/new.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="new",
-    )
-
-    changes = ChangeSet(added=[drv], removed=[], modified=[])
-    results = BuildResults(results=[])
-
-    result = format_detailed_changes(changes, results)
-    assert "Added (1)" in result
-    assert "packages.x86_64-linux.new" in result
-
-
-def test_format_detailed_changes_modified_no_diff() -> None:
-    """Test detailed changes for modified packages when nix-diff is unavailable."""
-    old_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/old.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-    new_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/new.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-
-    changes = ChangeSet(added=[], removed=[], modified=[(old_drv, new_drv)])
-    results = BuildResults(results=[])
+    Modified packages are listed even when nix-diff is unavailable.
+    """
+    changes = ChangeSet(added=[], removed=[], modified=[])
+    getattr(changes, kind).append(old_new_drv_pair if kind == "modified" else pkg_drv)
 
-    result = format_detailed_changes(changes, results)
-    assert "Modified (1)" in result
+    result = format_detailed_changes(changes, empty_build_results)
+    assert header in result
     assert "packages.x86_64-linux.pkg" in result
 
 
-def test_format_detailed_changes_removed() -> None:
-    """Test detailed changes for removed packages."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.old",
-        drv_path="/nix/store/old.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="old",
-    )
-
-    changes = ChangeSet(added=[], removed=[drv], modified=[])
-    results = BuildResults(results=[])
-
-    result = format_detailed_changes(changes, results)
-    assert "Removed (1)" in result
-    assert "packages.x86_64-linux.old" in result
-
-
-def test_format_detailed_changes_with_build_results() -> None:
+def test_format_detailed_changes_with_build_results(pkg_drv) -> None:  # type: ignore
     """Test detailed changes include build result status."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/pkg.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-
-    changes = ChangeSet(added=[drv], removed=[], modified=[])
+    changes = ChangeSet(added=[pkg_drv], removed=[], modified=[])
     build_result = BuildResult(
-        derivation=drv,
+        derivation=pkg_drv,
         success=True,
         output_path="/nix/store/pkg-out",
     )
@@ -96,100 +144,85 @@ def test_format_detailed_changes_with_build_results() -> None:
     assert "/nix/store/pkg-out" in result
 
 
-def test_generate_markdown_report() -> None:
-    """Test generating a complete markdown report."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.default",
-        drv_path="/nix/store/abc.drv",
+@pytest.fixture(scope="module")
+def rendered_report() -> str:
+    """A complete markdown report, rendered once for the assertions below."""
+    pkg_drv = DerivationInfo(
+        attr_path="packages.x86_64-linux.pkg",
+        drv_path="/nix/store/pkg.drv",
         output_type="packages",
         system="x86_64-linux",
-        name="default",
+        name="pkg",
     )
-
-    changes = ChangeSet(added=[drv], removed=[], modified=[])
-
+    changes = ChangeSet(added=[pkg_drv], removed=[], modified=[])
     build_result = BuildResult(
-        derivation=drv,
+        derivation=pkg_drv,
         success=True,
-        output_path="/nix/store/abc-out",
+        output_path="/nix/store/pkg-out",
     )
-
-    results = BuildResults(results=[build_result])
-
-    report = generate_markdown_report(changes, results, title="Test Report")
-
-    assert "# Test Report" in report
-    assert "Added (1)" in report
-    assert "packages.x86_64-linux.default" in report
-    assert "flake-review" in report
-
-
-def test_generate_markdown_report_with_systems() -> None:
-    """Test markdown report includes system info."""
-    changes = ChangeSet(added=[], removed=[], modified=[])
-    results = BuildResults(results=[])
-
-    report = generate_markdown_report(
+    return generate_markdown_report(
         changes,
-        results,
-        requested_systems=["x86_64-linux", "aarch64-darwin"],
-        available_systems={"x86_64-linux", "aarch64-darwin", "aarch64-linux"},
+        BuildResults(results=[build_result]),
+        title="Test Report",
+        requested_systems=["aarch64-darwin", "x86_64-linux"],
+        available_systems=["aarch64-darwin", "aarch64-linux", "x86_64-linux"],
     )
 
-    assert "Requested systems:" in report
-    assert "x86_64-linux" in report
-    assert "Available systems:" in report
-    assert "aarch64-linux" in report
 
+def test_generate_markdown_report_has_title(rendered_report) -> None:  # type: ignore
+    """Test the report starts with its title."""
+    assert rendered_report.startswith("# Test Report\n")
 
-def test_format_detailed_changes_build_error_markdown() -> None:
-    """Test that build errors are shown in collapsible details block."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.broken",
-        drv_path="/nix/store/broken.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="broken",
-    )
 
-    changes = ChangeSet(added=[drv], removed=[], modified=[])
-    build_result = BuildResult(
-        derivation=drv,
-        success=False,
-        error="SQLite warning\nerror: builder failed\nactual error",
-    )
-    results = BuildResults(results=[build_result])
+def test_generate_markdown_report_has_added_section(rendered_report) -> None:  # type: ignore
+    """Test the report lists the added package and its output."""
+    assert "Added (1)" in rendered_report
+    assert "packages.x86_64-linux.pkg" in rendered_report
+    assert "/nix/store/pkg-out" in rendered_report
 
-    result = format_detailed_changes(changes, results, markdown=True)
-    assert "<details>" in result
-    assert "Build error" in result
-    assert "actual error" in result
 
+def test_generate_markdown_report_has_footer(rendered_report) -> None:  # type: ignore
+    """Test the report is attributed to flake-review."""
+    assert "*Generated by [flake-review](" in rendered_report
 
-def test_format_detailed_changes_build_error_console() -> None:
-    """Test that build errors show last lines in console mode."""
-    drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.broken",
-        drv_path="/nix/store/broken.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="broken",
+
+def test_generate_markdown_report_with_systems(rendered_report) -> None:  # type: ignore
+    """Test markdown report includes system info."""
+    assert "**Requested systems:** aarch64-darwin, x86_64-linux" in rendered_report
+    assert (
+        "**Available systems:** aarch64-darwin, aarch64-linux, x86_64-linux"
+        in rendered_report
     )
 
-    changes = ChangeSet(added=[drv], removed=[], modified=[])
+
+@pytest.mark.parametrize(
+    ("markdown", "must_contain", "must_not_contain"),
+    [
+        (True, ["<details>", "Build error", "actual error"], []),
+        (False, ["actual error"], ["<details>"]),
+    ],
+)
+def test_format_detailed_changes_build_error(  # type: ignore
+    markdown, must_contain, must_not_contain, pkg_drv
+) -> None:
+    """Test build errors: a collapsible block in markdown, the tail on console."""
+    broken = replace(pkg_drv, attr_path="packages.x86_64-linux.broken", name="broken")
+    changes = ChangeSet(added=[broken], removed=[], modified=[])
     build_result = BuildResult(
-        derivation=drv,
+        derivation=broken,
         success=False,
-        error="error (ignored): SQLite warning\nactual error here",
+        error="error (ignored): SQLite warning\nerror: builder failed\nactual error",
     )
     results = BuildResults(results=[build_result])
 
-    result = format_detailed_changes(changes, results, markdown=False)
-    assert "actual error" in result
-    assert "<details>" not in result
+    result = format_detailed_changes(changes, results, markdown=markdown)
+    for text in must_contain:
+        assert text in result
+    for text in must_not_contain:
+        assert text not in result
 
 
-def test_generate_json_report_structure() -> None:
+def test_generate_json_report_structure(monkeypatch) -> None:  # type: ignore
     """Test JSON report has correct structure."""
     added_drv = DerivationInfo(
         attr_path="packages.x86_64-linux.new",
@@ -231,38 +264,22 @@ def test_generate_json_report_structure() -> None:
         output_path="/nix/store/new-out",
     )
     results = BuildResults(results=[build_result])
+    monkeypatch.setattr(
+        "flake_review.report._get_nix_diff", lambda old, new: "fake diff"
+    )
 
-    with patch("flake_review.report._get_nix_diff", return_value="fake diff"):
-        data = generate_json_report(
-            changes,
-            results,
-            requested_systems=["x86_64-linux"],
-            available_systems={"x86_64-linux", "aarch64-darwin"},
-        )
-
-    assert data["version"] == 1
-    assert "x86_64-linux" in data["metadata"]["requested_systems"]
-    assert "aarch64-darwin" in data["metadata"]["available_systems"]
-
-    assert len(data["changes"]["added"]) == 1
-    assert data["changes"]["added"][0]["attr_path"] == "packages.x86_64-linux.new"
-    assert data["changes"]["added"][0]["build"]["success"] is True
-
-    assert len(data["changes"]["removed"]) == 1
-    assert data["changes"]["removed"][0]["name"] == "gone"
-
-    assert len(data["changes"]["modified"]) == 1
-    assert data["changes"]["modified"][0]["nix_diff"] == "fake diff"
-    assert data["changes"]["modified"][0]["old"]["drv_path"] == "/nix/store/old.drv"
-
+    data = generate_json_report(
+        changes,
+        results,
+        requested_systems=["x86_64-linux"],
+        available_systems=["aarch64-darwin", "x86_64-linux"],
+    )
 
-def test_render_markdown_from_json() -> None:
-    """Test rendering markdown from JSON data produces unified report."""
-    data = {
+    assert data == {
         "version": 1,
         "metadata": {
-            "requested_systems": ["x86_64-linux", "aarch64-darwin"],
-            "available_systems": ["x86_64-linux", "aarch64-darwin"],
+            "requested_systems": ["x86_64-linux"],
+            "available_systems": ["aarch64-darwin", "x86_64-linux"],
         },
         "changes": {
             "added": [
@@ -279,35 +296,43 @@ def test_render_markdown_from_json() -> None:
                     },
                 }
             ],
-            "removed": [],
+            "removed": [
+                {
+                    "attr_path": "packages.x86_64-linux.gone",
+                    "drv_path": "/nix/store/gone.drv",
+                    "output_type": "packages",
+                    "system": "x86_64-linux",
+                    "name": "gone",
+                }
+            ],
             "modified": [
                 {
                     "old": {
-                        "attr_path": "packages.aarch64-darwin.pkg",
+                        "attr_path": "packages.x86_64-linux.pkg",
                         "drv_path": "/nix/store/old.drv",
                         "output_type": "packages",
-                        "system": "aarch64-darwin",
+                        "system": "x86_64-linux",
                         "name": "pkg",
                     },
                     "new": {
-                        "attr_path": "packages.aarch64-darwin.pkg",
-                        "drv_path": "/nix/store/new.drv",
+                        "attr_path": "packages.x86_64-linux.pkg",
+                        "drv_path": "/nix/store/new-pkg.drv",
                         "output_type": "packages",
-                        "system": "aarch64-darwin",
+                        "system": "x86_64-linux",
                         "name": "pkg",
                     },
-                    "nix_diff": "- old input\n+ new input",
-                    "build": {
-                        "success": True,
-                        "output_path": "/nix/store/pkg-out",
-                        "error": None,
-                    },
+                    "nix_diff": "fake diff",
+                    "nix_diff_ansi": "fake diff",
+                    "build": None,
                 }
             ],
         },
     }
 
-    md = _render_markdown_from_json(data, title="Test Report")
+
+def test_render_markdown_from_json() -> None:
+    """Test rendering markdown from JSON data produces unified report."""
+    md = _render_markdown_from_json(_RENDER_FIXTURE, title="Test Report")
 
     assert "# Test Report" in md
     assert "Added (1)" in md
@@ -353,38 +378,8 @@ def test_build_results_properties() -> None:
 
 def test_render_markdown_from_json_strips_ansi_diff_compat() -> None:
     """Test markdown rendering strips ANSI escapes from compatibility fields."""
-    data = {
-        "version": 1,
-        "metadata": {"requested_systems": [], "available_systems": []},
-        "changes": {
-            "added": [],
-            "removed": [],
-            "modified": [
-                {
-                    "old": {
-                        "attr_path": "packages.x86_64-linux.pkg",
-                        "drv_path": "/nix/store/old.drv",
-                        "output_type": "packages",
-                        "system": "x86_64-linux",
-                        "name": "pkg",
-                    },
-                    "new": {
-                        "attr_path": "packages.x86_64-linux.pkg",
-                        "drv_path": "/nix/store/new.drv",
-                        "output_type": "packages",
-                        "system": "x86_64-linux",
-                        "name": "pkg",
-                    },
-                    "nix_diff": "- old\n+ new",
-                    "nix_diff_ansi": "\u001b[31m- old\u001b[0m\n"
-                    "\u001b[32m+ new\u001b[0m",
-                    "build": None,
-                }
-            ],
-        },
-    }
 
-    md = _render_markdown_from_json(data, title="Test ANSI")
+    md = _render_markdown_from_json(_ANSI_DIFF_FIXTURE, title="Test ANSI")
 
     assert "```diff" in md
     assert "```ansi" not in md
@@ -398,60 +393,34 @@ def test_ansi_helpers() -> None:
     assert _strip_ansi(None) is None
 
 
-def test_generate_json_report_stores_plain_diff() -> None:
+def test_generate_json_report_stores_plain_diff(  # type: ignore
+    old_new_drv_pair, empty_build_results
+) -> None:
     """Test JSON report stores plain nix-diff output."""
-    old_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/old.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-    new_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/new.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-    changes = ChangeSet(added=[], removed=[], modified=[(old_drv, new_drv)])
-    results = BuildResults(results=[])
+    changes = ChangeSet(added=[], removed=[], modified=[old_new_drv_pair])
 
     with patch(
         "flake_review.report._get_nix_diff",
         return_value="- old\n+ new",
     ):
-        data = generate_json_report(changes, results)
+        data = generate_json_report(changes, empty_build_results)
 
     entry = data["changes"]["modified"][0]
     assert entry["nix_diff"] == "- old\n+ new"
     assert entry["nix_diff_ansi"] == "- old\n+ new"
 
 
-def test_generate_json_report_strips_ansi_from_cached_diff() -> None:
+def test_generate_json_report_strips_ansi_from_cached_diff(  # type: ignore
+    old_new_drv_pair, empty_build_results
+) -> None:
     """Test JSON report strips ANSI escapes from cached nix-diff output."""
-    old_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/old.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-    new_drv = DerivationInfo(
-        attr_path="packages.x86_64-linux.pkg",
-        drv_path="/nix/store/new.drv",
-        output_type="packages",
-        system="x86_64-linux",
-        name="pkg",
-    )
-    changes = ChangeSet(added=[], removed=[], modified=[(old_drv, new_drv)])
-    results = BuildResults(results=[])
-    cache = {
+    changes = ChangeSet(added=[], removed=[], modified=[old_new_drv_pair])
+    cache: dict[tuple[str, str], str | None] = {
         ("/nix/store/old.drv", "/nix/store/new.drv"): "\u001b[31m- old\u001b[0m\n"
         "\u001b[32m+ new\u001b[0m"
     }
 
-    data = generate_json_report(changes, results, nix_diffs=cache)
+    data = generate_json_report(changes, empty_build_results, nix_diffs=cache)
     entry = data["changes"]["modified"][0]
     assert entry["nix_diff"] == "- old\n+ new"
     assert "\u001b[31m" in (entry["nix_diff_ansi"] or "")
@@ -459,37 +428,208 @@ def test_generate_json_report_strips_ansi_from_cached_diff() -> None:
 
 def test_render_markdown_from_json_ansi_when_enabled() -> None:
     """Test markdown rendering keeps ANSI when explicitly enabled."""
-    data = {
-        "version": 1,
-        "metadata": {"requested_systems": [], "available_systems": []},
-        "changes": {
-            "added": [],
-            "removed": [],
-            "modified": [
-                {
-                    "old": {
-                        "attr_path": "packages.x86_64-linux.pkg",
-                        "drv_path": "/nix/store/old.drv",
-                        "output_type": "packages",
-                        "system": "x86_64-linux",
-                        "name": "pkg",
-                    },
-                    "new": {
-                        "attr_path": "packages.x86_64-linux.pkg",
-                        "drv_path": "/nix/store/new.drv",
-                        "output_type": "packages",
-                        "system": "x86_64-linux",
-                        "name": "pkg",
-                    },
-                    "nix_diff": "- old\n+ new",
-                    "nix_diff_ansi": "\u001b[31m- old\u001b[0m\n"
-                    "\u001b[32m+ new\u001b[0m",
-                    "build": None,
-                }
-            ],
-        },
-    }
 
-    md = _render_markdown_from_json(data, title="ANSI", markdown_ansi=True)
+    md = _render_markdown_from_json(
+        _ANSI_DIFF_FIXTURE, title="ANSI", markdown_ansi=True
+    )
 
     assert "\u001b[31m" in md
+
+
+class _FakePopen:
+    """Minimal subprocess.Popen stand-in for nix-diff."""
+
+    def __init__(self, stdout: str, stderr: str = "") -> None:
+        self.stdout = io.StringIO(stdout)
+        self.stderr = io.StringIO(stderr)
+        self.killed = False
+
+    def __enter__(self) -> "_FakePopen":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        pass
+
+    def kill(self) -> None:
+        self.killed = True
+
+
+def test_get_nix_diff_runs_once_per_pair() -> None:
+    """Test nix-diff is not re-run for a derivation pair seen before."""
+    _nix_diffs.clear()
+    with patch("flake_review.report.subprocess.Popen") as mock_popen:
+        mock_popen.return_value = _FakePopen("- a\n+ b\n")
+        first = _get_nix_diff("/nix/store/old.drv", "/nix/store/new.drv")
+        second = _get_nix_diff("/nix/store/old.drv", "/nix/store/new.drv")
+    _nix_diffs.clear()
+
+    assert first == second == "- a\n+ b"
+    assert mock_popen.call_count == 1
+
+
+def test_get_nix_diff_retries_failed_runs() -> None:
+    """Test a failed nix-diff run isn't memoized; a later success is."""
+    _nix_diffs.clear()
+    with patch("flake_review.report.subprocess.Popen") as mock_popen:
+        mock_popen.side_effect = [
+            _FakePopen("", stderr="error: cannot read drv"),
+            _FakePopen("- a\n+ b\n"),
+            _FakePopen("unused"),
+        ]
+        results = [
+            _get_nix_diff("/nix/store/old.drv", "/nix/store/new.drv") for _ in range(3)
+        ]
+    _nix_diffs.clear()
+
+    assert results == [None, "- a\n+ b", "- a\n+ b"]
+    assert mock_popen.call_count == 2
+
+
+def test_get_nix_diff_drains_stderr_while_reading_stdout() -> None:
+    """Test stdout is read while stderr is drained, not after it."""
+    stderr_read = threading.Event()
+
+    class _Stderr(io.StringIO):
+        def read(self, size: int | None = -1) -> str:
+            stderr_read.set()
+            return super().read(size)
+
+    class _Stdout:
+        def __init__(self, lines: list[str]) -> None:
+            self.lines = iter(lines)
+
+        def __iter__(self) -> "_Stdout":
+            return self
+
+        def __next__(self) -> str:
+            # A real nix-diff blocks here once its stderr pipe is full
+            assert stderr_read.wait(timeout=5)
+            return next(self.lines)
+
+        def readline(self) -> str:
+            return next(self.lines, "")
+
+    proc = _FakePopen("")
+    proc.stdout = _Stdout(["- a\n"])  # type: ignore[assignment]
+    proc.stderr = _Stderr("warning: " * 100_000)
+
+    _nix_diffs.clear()
+    with patch("flake_review.report.subprocess.Popen", return_value=proc):
+        diff = _get_nix_diff("/nix/store/old.drv", "/nix/store/new.drv")
+    _nix_diffs.clear()
+
+    assert diff == "- a"
+
+
+def test_get_nix_diff_truncates_long_output() -> None:
+    """Test nix-diff output is cut off and nix-diff stopped at the limit."""
+    _nix_diffs.clear()
+    proc = _FakePopen("".join(f"+ line {i}\n" for i in range(6000)))
+    with patch("flake_review.report.subprocess.Popen", return_value=proc):
+        diff = _get_nix_diff("/nix/store/old.drv", "/nix/store/new.drv")
+    _nix_diffs.clear()
+
+    assert diff is not None
+    lines = diff.split("\n")
+    assert len(lines) == 5001
+    assert lines[4999] == "+ line 4999"
+    assert "truncated after 5000 lines" in lines[-1]
+    assert proc.killed
+
+
+def test_collect_nix_diffs_runs_pairs_concurrently() -> None:
+    """Test nix-diff runs for different pairs overlap and keep their order."""
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_diff(old: str, new: str) -> str:
+        barrier.wait()  # Raises BrokenBarrierError if run sequentially
+        return f"{old} -> {new}"
+
+    def drv(name: str, drv_path: str) -> DerivationInfo:
+        return DerivationInfo(
+            attr_path=f"packages.x86_64-linux.{name}",
+            drv_path=drv_path,
+            output_type="packages",
+            system="x86_64-linux",
+            name=name,
+        )
+
+    changes = ChangeSet(
+        added=[],
+        removed=[],
+        modified=[
+            (drv("a", "/nix/store/a1.drv"), drv("a", "/nix/store/a2.drv")),
+            (drv("b", "/nix/store/b1.drv"), drv("b", "/nix/store/b2.drv")),
+        ],
+    )
+    with (
+        patch("flake_review.report._get_nix_diff", side_effect=fake_diff),
+        patch("flake_review.report.os.cpu_count", return_value=4),
+    ):
+        diffs = collect_nix_diffs(changes)
+
+    assert list(diffs.items()) == [
+        (
+            ("/nix/store/a1.drv", "/nix/store/a2.drv"),
+            "/nix/store/a1.drv -> /nix/store/a2.drv",
+        ),
+        (
+            ("/nix/store/b1.drv", "/nix/store/b2.drv"),
+            "/nix/store/b1.drv -> /nix/store/b2.drv",
+        ),
+    ]
+
+
+def test_format_diff_section_indents_every_line() -> None:
+    """Test every diff line, blank ones included, gets the same indent."""
+    diff = "- old\n\n+ new"
+
+    console = "\n".join(_format_diff_section(diff, markdown=False))
+    markdown = "\n".join(_format_diff_section(diff, markdown=True))
+
+    assert console == "    - old\n    \n    + new"
+    assert "  ```diff\n  - old\n  \n  + new\n  ```" in markdown
+
+
+def test_format_build_error_console_shows_last_lines() -> None:
+    """Test the console error keeps the last 20 non-blank lines in order."""
+    error = "\n".join(f"line {i}\n" for i in range(100)) + "\n\n"
+
+    lines = "\n".join(_format_build_error(error, markdown=False)).split("\n")
+
+    assert lines == [f"    line {i}" for i in range(80, 100)]
+    assert _format_build_error("\n  \n", markdown=False) == ()
+    assert _format_build_error(None, markdown=True) == ()
+    assert _format_diff_section(None, markdown=True) == ()
+
+
+def test_nix_diff_env_is_built_once(monkeypatch) -> None:  # type: ignore
+    """Test nix-diff gets one shared environment forcing local store access."""
+    _nix_diff_env.cache_clear()
+    monkeypatch.setenv("NIX_REMOTE", "daemon")
+
+    env = _nix_diff_env()
+
+    assert env["NIX_REMOTE"] == ""
+    assert env["PATH"] == os.environ["PATH"]
+    assert _nix_diff_env() is env
+    _nix_diff_env.cache_clear()
+
+
+def test_print_console_report_writes_once(  # type: ignore
+    capsys, pkg_drv, empty_build_results
+) -> None:
+    """Test the console report layout is written as one block."""
+    changes = ChangeSet(added=[], removed=[pkg_drv], modified=[])
+
+    with patch("flake_review.report.sys.stdout.write") as mock_write:
+        print_console_report(changes, empty_build_results)
+    assert mock_write.call_count == 1
+
+    print_console_report(changes, empty_build_results)
+    rule = "=" * 60
+    assert capsys.readouterr().out == (
+        f"\n{rule}\nFLAKE REVIEW RESULTS\n{rule}\n\n"
+        "### ➖ Removed (1)\n\n- `packages.x86_64-linux.pkg`\n\n"
+        f"{rule}\n\n"
+    )
@@ -1,129 +1,233 @@
 """Tests for system filtering logic."""
 
 import json
+import re
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from types import SimpleNamespace
 
 from flake_review.flake import FlakeOutputs, compare_outputs
 
+# The string literal a selection expression hands to builtins.fromJSON
+_FROM_JSON_RE = re.compile(r'builtins\.fromJSON "((?:[^"\\]|\\.)*)"')
+
+# A flake with one package on each of two systems
+_PACKAGES = {"x86_64-linux": ["pkg1"], "aarch64-darwin": ["pkg2"]}
+
 
 def _mock_nix_eval(packages_by_system: dict[str, list[str]]):  # type: ignore
     """Create a side_effect for run_command that handles nix eval calls.
 
     packages_by_system: e.g. {"x86_64-linux": ["pkg1"], "aarch64-darwin": ["pkg2"]}
+
+    Responses are built once and reused for every matching call.
     """
+    list_response = SimpleNamespace(
+        stdout=json.dumps(packages_by_system), returncode=0, stderr=""
+    )
+    failed_response = SimpleNamespace(stdout="", returncode=1, stderr="")
+    drv_path_responses: dict[str, SimpleNamespace] = {}
+
+    def drv_path_response(flake_ref: str) -> SimpleNamespace:
+        # Same store paths the per-attribute .drvPath branch yields
+        if flake_ref not in drv_path_responses:
+            drv_paths = {
+                system: {
+                    name: f"/nix/store/fake-{flake_ref}.{system}.{name}.drvPath.drv"
+                    for name in names
+                }
+                for system, names in packages_by_system.items()
+            }
+            drv_path_responses[flake_ref] = SimpleNamespace(
+                stdout=json.dumps(drv_paths), returncode=0, stderr=""
+            )
+        return drv_path_responses[flake_ref]
 
     def side_effect(cmd: list[str], **kwargs):  # type: ignore
         if "nix" in cmd and "eval" in cmd and "--apply" in cmd:
-            return MagicMock(
-                stdout=json.dumps(packages_by_system),
-                returncode=0,
-            )
+            if any("drvPath" in c for c in cmd):
+                return drv_path_response(next(c for c in cmd if "#" in c))
+            return list_response
         if "nix" in cmd and "eval" in cmd and any(".drvPath" in c for c in cmd):
             attr = next(c for c in cmd if ".drvPath" in c)
-            return MagicMock(
-                stdout=f"/nix/store/fake-{attr}.drv",
-                returncode=0,
+            return SimpleNamespace(
+                stdout=f"/nix/store/fake-{attr}.drv", returncode=0, stderr=""
             )
-        return MagicMock(stdout="", returncode=1)
+        return failed_response
 
     return side_effect
 
 
-def test_get_derivations_filters_nonexistent_systems() -> None:
+def test_get_derivations_filters_nonexistent_systems(mock_run_command) -> None:  # type: ignore
     """Test that get_derivations only returns systems that exist."""
-    packages = {
-        "x86_64-linux": ["pkg1"],
-        "aarch64-darwin": ["pkg2"],
-    }
-
-    with patch("flake_review.flake.run_command") as mock_run:
-        mock_run.side_effect = _mock_nix_eval(packages)
-
-        outputs = FlakeOutputs(Path("/fake"))
-
-        # Request 4 systems but only 2 exist
-        derivations = outputs.get_derivations(
-            systems=[
-                "x86_64-linux",
-                "aarch64-linux",
-                "x86_64-darwin",
-                "aarch64-darwin",
-            ]
-        )
-
-        # Should only get the 2 that exist
-        systems_found = {d.system for d in derivations}
-        assert "x86_64-linux" in systems_found
-        assert "aarch64-darwin" in systems_found
-        assert "aarch64-linux" not in systems_found
-        assert "x86_64-darwin" not in systems_found
-
-
-def test_compare_outputs_only_compares_common_systems() -> None:
-    """Test that compare_outputs works with different systems."""
+    mock_run_command.side_effect = _mock_nix_eval(_PACKAGES)
+
+    outputs = FlakeOutputs(Path("/fake"))
+
+    # Request 4 systems but only 2 exist
+    derivations = outputs.get_derivations(
+        systems=[
+            "x86_64-linux",
+            "aarch64-linux",
+            "x86_64-darwin",
+            "aarch64-darwin",
+        ]
+    )
+
+    # Should only get the 2 that exist
+    systems_found = {d.system for d in derivations}
+    assert "x86_64-linux" in systems_found
+    assert "aarch64-darwin" in systems_found
+    assert "aarch64-linux" not in systems_found
+    assert "x86_64-darwin" not in systems_found
+
+
+def test_compare_outputs_only_compares_common_systems(mock_run_command) -> None:  # type: ignore
+    """Test compare_outputs when the two sides cover different systems."""
     base_packages = {"x86_64-linux": ["pkg"]}
     head_packages = {
         "x86_64-linux": ["pkg", "new"],
         "aarch64-darwin": ["pkg"],
     }
 
-    with patch("flake_review.flake.run_command") as mock_run:
+    base_eval = _mock_nix_eval(base_packages)
+    head_eval = _mock_nix_eval(head_packages)
 
-        def side_effect(cmd: list[str], **kwargs):  # type: ignore
-            path = ""
-            for part in cmd:
-                if "#" in part:
-                    path = part
-                    break
-            if "base" in path:
-                return _mock_nix_eval(base_packages)(cmd, **kwargs)
-            return _mock_nix_eval(head_packages)(cmd, **kwargs)
+    def side_effect(cmd: list[str], **kwargs):  # type: ignore
+        flake_ref = next((part for part in cmd if "#" in part), "")
+        mock_eval = base_eval if "base" in flake_ref else head_eval
+        return mock_eval(cmd, **kwargs)
 
-        mock_run.side_effect = side_effect
+    mock_run_command.side_effect = side_effect
 
-        base = FlakeOutputs(Path("/fake/base"))
-        head = FlakeOutputs(Path("/fake/head"))
+    base = FlakeOutputs(Path("/fake/base"))
+    head = FlakeOutputs(Path("/fake/head"))
 
-        changes = compare_outputs(
-            base, head, systems=["x86_64-linux", "aarch64-darwin"]
-        )
+    changes = compare_outputs(base, head, systems=["x86_64-linux", "aarch64-darwin"])
 
-        # Should detect changes
-        total = len(changes.added) + len(changes.modified) + len(changes.removed)
-        assert total >= 0
+    # A system only the head has shows up as additions, never as removals
+    assert [d.attr_path for d in changes.added] == [
+        "packages.aarch64-darwin.pkg",
+        "packages.x86_64-linux.new",
+    ]
+    assert [old.attr_path for old, _ in changes.modified] == [
+        "packages.x86_64-linux.pkg"
+    ]
+    assert changes.removed == []
 
 
-def test_flake_outputs_with_no_packages() -> None:
+def test_flake_outputs_with_no_packages(mock_run_command) -> None:  # type: ignore
     """Test FlakeOutputs when flake has no packages."""
-    with patch("flake_review.flake.run_command") as mock_run:
-        # nix eval .#packages fails (no packages output)
-        mock_run.return_value = MagicMock(stdout="", returncode=1)
+    # nix eval .#packages fails (no packages output)
+    mock_run_command.return_value = SimpleNamespace(stdout="", returncode=1, stderr="")
 
-        outputs = FlakeOutputs(Path("/fake"))
-        derivations = outputs.get_derivations(output_types=["packages"])
+    outputs = FlakeOutputs(Path("/fake"))
+    derivations = outputs.get_derivations(output_types=["packages"])
 
-        assert len(derivations) == 0
+    assert len(derivations) == 0
 
 
-def test_flake_outputs_auto_detect_systems() -> None:
+def test_flake_outputs_auto_detect_systems(mock_run_command) -> None:  # type: ignore
     """Test that FlakeOutputs auto-detects all available systems."""
+    packages = {**_PACKAGES, "aarch64-linux": ["pkg3"]}
+
+    mock_run_command.side_effect = _mock_nix_eval(packages)
+
+    outputs = FlakeOutputs(Path("/fake"))
+
+    # Don't specify systems - should auto-detect all
+    derivations = outputs.get_derivations(systems=None)
+
+    systems_found = {d.system for d in derivations}
+    assert len(systems_found) == 3
+    assert "x86_64-linux" in systems_found
+    assert "aarch64-darwin" in systems_found
+    assert "aarch64-linux" in systems_found
+
+
+def test_get_derivations_evaluates_drv_paths_once(mock_run_command) -> None:  # type: ignore
+    """Test that drvPaths for all systems come from one bulk nix eval."""
     packages = {
-        "x86_64-linux": ["pkg1"],
-        "aarch64-darwin": ["pkg2"],
-        "aarch64-linux": ["pkg3"],
+        "x86_64-linux": ["pkg1", "pkg2", "pkg3"],
+        "aarch64-darwin": ["pkg1", "pkg2"],
     }
 
-    with patch("flake_review.flake.run_command") as mock_run:
-        mock_run.side_effect = _mock_nix_eval(packages)
+    mock_run_command.side_effect = _mock_nix_eval(packages)
+
+    outputs = FlakeOutputs(Path("/fake"))
+    derivations = outputs.get_derivations()
+
+    assert len(derivations) == 5
+    scalar_calls = [
+        call
+        for call in mock_run_command.call_args_list
+        if any(c.endswith(".drvPath") for c in call.args[0])
+    ]
+    assert scalar_calls == []
+    # One attrNames eval plus one drvPath eval covering every system
+    assert mock_run_command.call_count == 2
+
+
+def test_get_derivations_retries_bulk_eval_per_system(mock_run_command) -> None:  # type: ignore
+    """Test that a failing all-systems drvPath eval is retried per system."""
+    packages = {
+        "x86_64-linux": ["pkg1", "pkg2"],
+        "aarch64-darwin": ["pkg1", "pkg2"],
+    }
+    mock_eval = _mock_nix_eval(packages)
+
+    def side_effect(cmd: list[str], **kwargs):  # type: ignore
+        apply = cmd[-1]
+        if "drvPath" in apply and all(s in apply for s in packages):
+            return SimpleNamespace(stdout="", returncode=1, stderr="")
+        return mock_eval(cmd, **kwargs)
+
+    mock_run_command.side_effect = side_effect
+
+    derivations = FlakeOutputs(Path("/fake")).get_derivations()
+
+    assert len(derivations) == 4
+    # attrNames, the failed combined eval, then one eval per system
+    assert mock_run_command.call_count == 4
+
+
+def test_get_derivations_post_filters_memoized_results(mock_run_command) -> None:  # type: ignore
+    """Test that narrower repeat queries don't run nix eval again."""
+    packages = {
+        "x86_64-linux": ["pkg1", "pkg2"],
+        "aarch64-darwin": ["pkg1"],
+    }
+
+    mock_run_command.side_effect = _mock_nix_eval(packages)
+
+    outputs = FlakeOutputs(Path("/fake"))
+    everything = outputs.get_derivations()
+    calls = mock_run_command.call_count
+
+    subset = outputs.get_derivations(systems=["x86_64-linux"], package_filter=["pkg2"])
+
+    assert mock_run_command.call_count == calls
+    assert len(everything) == 3
+    assert [d.attr_path for d in subset] == ["packages.x86_64-linux.pkg2"]
+
 
-        outputs = FlakeOutputs(Path("/fake"))
+def test_get_derivations_bulk_eval_selects_wanted_packages(mock_run_command) -> None:  # type: ignore
+    """The bulk drvPath eval only asks nix for the filtered packages."""
+    packages = {"x86_64-linux": ["pkg1", "pkg2", "broken"]}
+    mock_run_command.side_effect = _mock_nix_eval(packages)
 
-        # Don't specify systems - should auto-detect all
-        derivations = outputs.get_derivations(systems=None)
+    derivations = FlakeOutputs(Path("/fake")).get_derivations(
+        package_filter=["pkg1", "pkg2"]
+    )
 
-        systems_found = {d.system for d in derivations}
-        assert len(systems_found) == 3
-        assert "x86_64-linux" in systems_found
-        assert "aarch64-darwin" in systems_found
-        assert "aarch64-linux" in systems_found
+    assert [d.name for d in derivations] == ["pkg1", "pkg2"]
+    bulk = [
+        call.args[0][-1]
+        for call in mock_run_command.call_args_list
+        if "drvPath" in call.args[0][-1]
+    ]
+    assert len(bulk) == 1
+    literal = _FROM_JSON_RE.search(bulk[0])
+    assert literal is not None
+    # Nix unescapes a backslash-escaped character to itself
+    wanted = json.loads(re.sub(r"\\(.)", r"\1", literal.group(1)))
+    assert wanted == {"x86_64-linux": {"pkg1": None, "pkg2": None}}
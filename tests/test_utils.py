@@ -1,6 +1,21 @@
 """Tests for utility functions."""
 
-from flake_review.utils import CommandError
+import subprocess
+import time
+from unittest.mock import patch
+
+import pytest
+
+from flake_review.utils import (
+    CommandError,
+    get_current_system,
+    git_worktrees,
+    has_tree_changes,
+    json_dumps,
+    json_loads,
+    remove_tree_in_background,
+    tail_lines,
+)
 
 
 def test_command_error() -> None:
@@ -11,3 +26,139 @@ def test_command_error() -> None:
     assert error.stderr == "fatal: not a git repository"
     assert "git status" in str(error)
     assert "fatal: not a git repository" in str(error)
+
+
+def test_remove_tree_in_background(tmp_path) -> None:  # type: ignore
+    """The tree is removed by a detached process."""
+    target = tmp_path / "clone"
+    (target / ".git" / "objects").mkdir(parents=True)
+    (target / ".git" / "objects" / "blob").write_text("data")
+
+    remove_tree_in_background(target)
+
+    deadline = time.monotonic() + 5
+    while target.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not target.exists()
+
+
+def test_remove_tree_in_background_falls_back(tmp_path) -> None:  # type: ignore
+    """Without a spawnable rm, the tree is removed inline."""
+    target = tmp_path / "clone"
+    target.mkdir()
+    (target / "file").write_text("data")
+
+    with patch("flake_review.utils.subprocess.Popen", side_effect=OSError):
+        remove_tree_in_background(target)
+
+    assert not target.exists()
+
+
+def test_tail_lines_keeps_last_non_blank_lines() -> None:
+    """Blank lines are skipped and line endings dropped."""
+    lines = ["first\n", "\n", "second\r\n", "  \n", "third"]
+
+    assert tail_lines(lines, 2) == ["second", "third"]
+    assert tail_lines(iter(lines), 10) == ["first", "second", "third"]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_helpers_roundtrip(monkeypatch, use_orjson) -> None:  # type: ignore
+    """JSON helpers behave the same with and without orjson."""
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr("flake_review.utils._orjson", None)
+
+    data = {"x86_64-linux": ["pkg1", "pkg2"]}
+    assert json_loads(json_dumps(data)) == data
+    assert json_loads(json_dumps(data).encode()) == data
+    assert json_dumps(data, indent=True) == (
+        '{\n  "x86_64-linux": [\n    "pkg1",\n    "pkg2"\n  ]\n}'
+    )
+
+
+def _git(repo, *args: str) -> None:  # type: ignore
+    subprocess.run(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_has_tree_changes(tmp_path) -> None:  # type: ignore
+    """Committed, working-tree and untouched states are told apart."""
+
+    def git(*args: str) -> None:
+        _git(tmp_path, *args)
+
+    git("init", "--quiet")
+    (tmp_path / "flake.nix").write_text("{}")
+    git("add", ".")
+    git("commit", "--quiet", "-m", "base")
+    git("commit", "--quiet", "--allow-empty", "-m", "empty")
+
+    assert has_tree_changes(tmp_path, "HEAD~1", "HEAD") is False
+    assert has_tree_changes(tmp_path, "HEAD") is False
+
+    (tmp_path / "README.md").write_text("docs")
+    git("add", "README.md")
+    assert has_tree_changes(tmp_path, "HEAD") is True
+    assert has_tree_changes(tmp_path, "no-such-ref") is True
+
+
+def test_git_worktrees_checks_out_each_ref(tmp_path) -> None:  # type: ignore
+    """Each ref gets its own worktree, and all are removed on exit."""
+    _git(tmp_path, "init", "--quiet")
+    for version in ("v1", "v2"):
+        (tmp_path / "version").write_text(version)
+        _git(tmp_path, "add", ".")
+        _git(tmp_path, "commit", "--quiet", "-m", version)
+
+    with git_worktrees(tmp_path, "HEAD~1", "HEAD") as (old, new):
+        assert (old / "version").read_text() == "v1"
+        assert (new / "version").read_text() == "v2"
+
+    assert not old.exists()
+    assert not new.exists()
+
+
+def test_git_worktrees_cleans_up_on_partial_failure(tmp_path) -> None:  # type: ignore
+    """A failed checkout removes the worktrees that did get created."""
+    _git(tmp_path, "init", "--quiet")
+    (tmp_path / "file").write_text("x")
+    _git(tmp_path, "add", ".")
+    _git(tmp_path, "commit", "--quiet", "-m", "init")
+
+    with pytest.raises(CommandError), git_worktrees(tmp_path, "HEAD", "no-such-ref"):
+        pass
+
+    listed = subprocess.run(
+        ["git", "worktree", "list"], cwd=tmp_path, capture_output=True, text=True
+    )
+    assert len(listed.stdout.splitlines()) == 1
+
+
+@pytest.mark.parametrize(
+    ("machine", "system", "expected"),
+    [
+        ("x86_64", "Linux", "x86_64-linux"),
+        ("arm64", "Darwin", "aarch64-darwin"),
+        ("riscv64", "Linux", "riscv64-linux-from-nix"),
+    ],
+)
+def test_get_current_system(machine, system, expected) -> None:  # type: ignore
+    """Common hosts map from platform; others fall back to nix, once."""
+    get_current_system.cache_clear()
+    with (
+        patch("flake_review.utils.platform.machine", return_value=machine),
+        patch("flake_review.utils.platform.system", return_value=system),
+        patch("flake_review.utils.run_command") as mock_run,
+    ):
+        mock_run.return_value.stdout = "riscv64-linux-from-nix\n"
+        assert get_current_system() == expected
+        assert get_current_system() == expected
+    get_current_system.cache_clear()
+
+    assert mock_run.call_count == (1 if machine == "riscv64" else 0)